@@ -0,0 +1,181 @@
+"""End-of-period interest and fee accrual.
+
+Interest is computed from the time-weighted balance of every account
+over the period `[since, till)`, using its history:
+    *interest on the positive part at `rate` (annual),
+    *overdraft interest on the negative part at `overdraft_rate` (annual),
+    *a flat `fee` per account.
+Histories are exported as int64 columns of seconds and balances in cents
+(see `columnar`), so balance areas are exact integers. With NumPy they
+are computed for the whole book at once, without a Python step per
+operation; without it (or if they could overflow int64) a scalar loop
+goes over the same columns. Results are rounded once per account.
+Everything accrued for an account is appended to its history in one
+bulk posting, without `check_validity` and without printing.
+
+An account whose history already has an accrual posting for a period
+overlapping `[since, till)` is skipped, so running the accrual again
+(e.g. after an interrupted nightly job) never charges twice.
+"""
+import calendar
+import re
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+import columnar
+from user import Account
+
+
+SECONDS_PER_YEAR: int = 365 * 24 * 60 * 60
+TIME_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+# Descriptions of accrual postings, the period is `YYYY-MM-DD..YYYY-MM-DD`.
+ACCRUAL_PATTERN = re.compile(r"(?:Interest|Overdraft interest|Account fee) (\d{4}-\d{2}-\d{2})\.\.(\d{4}-\d{2}-\d{2})")
+INT64_MAX: int = 2 ** 63 - 1
+
+
+def to_epoch(moment: datetime) -> int:
+    # History times are read as UTC, as in `columnar`.
+    return calendar.timegm(moment.timetuple())
+
+
+def _round_cents(value: Decimal) -> int:
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def accrued(account: Account, since_day: str, till_day: str) -> bool:
+    """Whether the account was already accrued for a period overlapping
+    `[since_day, till_day)`, both `YYYY-MM-DD`.
+    """
+    for _, _, _, description, _ in account.snapshot().history:
+        match = ACCRUAL_PATTERN.fullmatch(description)
+        if match is not None and match[1] < till_day and since_day < match[2]:
+            return True
+    return False
+
+
+def balance_areas(columns: columnar.Columns, since: int, till: int) -> tuple[list[int], list[int]]:
+    """Returns integrals of the positive and the negative balance of
+    every account of `columns` over `[since, till)` (seconds since the
+    epoch), in cent-seconds (negative ones <= 0), indexed like
+    `columns.account_ids`.
+
+    Operation times are clipped to the period: operations before it
+    only make the opening balance, the ones after it last no time.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return _balance_areas_scalar(columns, since, till)
+    # An account's areas are at most its largest balance times the period.
+    largest: int = max((
+        int(numpy.abs(numpy.frombuffer(column, dtype=numpy.int64)).max())
+        for column in (columns.balance, columns.initial) if len(column)
+    ), default=0)
+    if largest * (till - since) > INT64_MAX:
+        return _balance_areas_scalar(columns, since, till)
+    return _balance_areas_numpy(numpy, columns, since, till)
+
+
+def _balance_areas_numpy(numpy, columns: columnar.Columns, since: int, till: int) -> tuple[list[int], list[int]]:
+    account = numpy.frombuffer(columns.account, dtype=numpy.int32)
+    time = numpy.frombuffer(columns.time, dtype=numpy.int64)
+    balance = numpy.frombuffer(columns.balance, dtype=numpy.int64)
+    initial = numpy.frombuffer(columns.initial, dtype=numpy.int64)
+    # Every account's operations are contiguous: a row is the first
+    # of its account if the account changes, the last one likewise.
+    changes = account[1:] != account[:-1]
+    first = numpy.concatenate(([True], changes))[:len(account)]
+    last = numpy.concatenate((changes, [True]))[:len(account)]
+
+    # Opening segment: initial balance till the first operation,
+    # or the whole period if there are none.
+    moments = numpy.clip(time, since, till)
+    opened = numpy.full(len(initial), till, dtype=numpy.int64)
+    opened[account[first]] = moments[first]
+    opening = initial * (opened - since)
+    positive = numpy.maximum(opening, 0)
+    negative = numpy.minimum(opening, 0)
+
+    # Balance after every operation lasts till the next operation
+    # of the account, or till the end of the period.
+    if len(account):
+        ends = numpy.empty_like(moments)
+        ends[:-1] = moments[1:]
+        ends[last] = till
+        areas = balance * (ends - moments)
+        starts = numpy.flatnonzero(first)
+        positive[account[starts]] += numpy.add.reduceat(numpy.maximum(areas, 0), starts)
+        negative[account[starts]] += numpy.add.reduceat(numpy.minimum(areas, 0), starts)
+    return positive.tolist(), negative.tolist()
+
+
+def _balance_areas_scalar(columns: columnar.Columns, since: int, till: int) -> tuple[list[int], list[int]]:
+    positive: list[int] = []
+    negative: list[int] = []
+    row: int = 0
+    for index, balance in enumerate(columns.initial):
+        cursor: int = since
+        account_positive: int = 0
+        account_negative: int = 0
+        while row < len(columns) and columns.account[row] == index:
+            moment: int = min(max(columns.time[row], since), till)
+            area: int = balance * (moment - cursor)
+            if area > 0:
+                account_positive += area
+            else:
+                account_negative += area
+            cursor = moment
+            balance = columns.balance[row]
+            row += 1
+        area = balance * (till - cursor)
+        if area > 0:
+            account_positive += area
+        else:
+            account_negative += area
+        positive.append(account_positive)
+        negative.append(account_negative)
+    return positive, negative
+
+
+def accrue(since: datetime, till: datetime, rate: Decimal,
+            overdraft_rate: Decimal = Decimal(0), fee: Decimal = Decimal(0),
+            accounts=None, now: datetime | None = None) -> dict[str, int]:
+    """Accrues interest and fees for `accounts` (all by default).
+    Returns totals in cents: `interest`, `overdraft`, `fees`, the number
+    of `accounts` processed and of accounts `skipped` as already accrued.
+    """
+    now_string: str = (now or datetime.now()).strftime(TIME_FORMAT)
+    since_day: str = f"{since:%Y-%m-%d}"
+    till_day: str = f"{till:%Y-%m-%d}"
+    period: str = f"{since_day}..{till_day}"
+    fee_cents: int = _round_cents(Decimal(fee) * 100)
+    # Annual rates per cent-second.
+    rate_per_second: Decimal = Decimal(rate) / SECONDS_PER_YEAR
+    overdraft_per_second: Decimal = Decimal(overdraft_rate) / SECONDS_PER_YEAR
+    totals: dict[str, int] = {"accounts": 0, "interest": 0, "overdraft": 0, "fees": 0, "skipped": 0}
+    pending: list[Account] = []
+    for account in list(accounts if accounts is not None else Account.accounts.values()):
+        if accrued(account, since_day, till_day):
+            totals["skipped"] += 1
+        else:
+            pending.append(account)
+
+    # Operations before the period only make the opening balance.
+    columns: columnar.Columns = columnar.book_columns(pending, since.strftime(TIME_FORMAT))
+    positives, negatives = balance_areas(columns, to_epoch(since), to_epoch(till))
+    for account, positive, negative in zip(pending, positives, negatives):
+        interest: int = _round_cents(positive * rate_per_second) if positive else 0
+        overdraft: int = _round_cents(-negative * overdraft_per_second) if negative else 0
+        operations: list[tuple[str, str, float, str]] = []
+        if interest > 0:
+            operations.append((now_string, "d", interest / 100, f"Interest {period}"))
+        if overdraft > 0:
+            operations.append((now_string, "w", overdraft / 100, f"Overdraft interest {period}"))
+        if fee_cents > 0:
+            operations.append((now_string, "w", fee_cents / 100, f"Account fee {period}"))
+        if operations:
+            account._post_many(operations)
+        totals["accounts"] += 1
+        totals["interest"] += interest
+        totals["overdraft"] += overdraft
+        totals["fees"] += fee_cents
+    return totals
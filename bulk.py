@@ -0,0 +1,289 @@
+"""Streaming bulk import and export of the whole book.
+
+A book is a flat stream of records, each one being a `dict` with
+the following fields (unused fields are empty):
+    *type: "user", "account" or "posting".
+    *id: user's ID, account's ID, or, for postings, ID of the account
+        the posting belongs to.
+    *owner_id: ID of the account's owner (accounts only).
+    *time: time of the posting in `YYYY-MM-DD HH:MinMin:SS` format.
+    *kind: "d" for deposits, "w" for withdrawals (postings only).
+    *amount: initial balance for accounts, amount of money for postings.
+    *description: description of the posting.
+
+Users must come before their accounts and accounts before
+their postings, which is the order `iter_book` produces.
+Supported files are CSV (`.csv`) and JSON Lines (`.jsonl`/`.ndjson`).
+"""
+import csv
+import itertools
+import json
+import math
+from datetime import datetime
+from typing import Iterable, Iterator
+from rich import print as rprint
+from exceptions import (
+    BulkImportError,
+    UnsupportedFormatError,
+)
+from user import Account, User
+
+
+FIELDS: tuple[str, ...] = ("type", "id", "owner_id", "time", "kind", "amount", "description")
+TIME_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+DEFAULT_CHUNK_SIZE: int = 10000
+
+Record = dict[str, str]
+
+
+def detect_format(path: str) -> str:
+    """Returns "csv" or "jsonl" depending on the file extension."""
+    if path.endswith(".csv"):
+        return "csv"
+    elif path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    rprint(f"[red]{path} [white]must be a [bold].csv [white]or a [bold].jsonl [white]file.")
+    raise UnsupportedFormatError
+
+
+def decode_line(line: str) -> Record:
+    """Parses a JSON Lines record. Raises `ValueError` saying what's
+    wrong if the line is not a JSON object.
+    """
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as error:
+        raise ValueError(f"invalid JSON: {error.msg} (column {error.colno})") from None
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    return record
+
+
+def read_records(path: str) -> Iterator[tuple[int, Record]]:
+    """Lazily reads `(line number, record)` pairs from a book file.
+    Raises `BulkImportError` on a line that is not a JSON object.
+    """
+    file_format: str = detect_format(path)
+    with open(path, newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record: Record = decode_line(line)
+                except ValueError as error:
+                    print_errors([(line_number, str(error))])
+                    raise BulkImportError
+                yield line_number, record
+
+
+def write_records(path: str, records: Iterable[Record]) -> int:
+    """Writes records one by one to a book file.
+    Returns the number of written records.
+    """
+    file_format: str = detect_format(path)
+    written: int = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.DictWriter(file, FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+                written += 1
+        else:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False))
+                file.write("\n")
+                written += 1
+    return written
+
+
+def iter_book() -> Iterator[Record]:
+    """Yields the records of the current book.
+    Only references to users and accounts are copied, histories are not.
+    """
+    for user in list(User.users.values()):
+        yield {"type": "user", "id": user.id}
+    for account in list(Account.accounts.values()):
+        yield {
+            "type": "account",
+            "id": account.id,
+            "owner_id": account.owner.id,
+            "amount": str(float(account._initial_balance)),
+        }
+        # Postings made during the export are left for the next one.
+        for time, kind, amount, description, _ in account.snapshot().history:
+            yield {
+                "type": "posting",
+                "id": account.id,
+                "time": time,
+                "kind": kind,
+                "amount": str(amount),
+                "description": description,
+            }
+
+
+def _validate_time(time: str) -> None:
+    # `fromisoformat` is an order of magnitude faster than `strptime`,
+    # the separator and digit checks pin it to `TIME_FORMAT`.
+    if len(time) != 19 or time[4] + time[7] + time[10] + time[13] + time[16] != "-- ::":
+        raise ValueError
+    digits: str = time[:4] + time[5:7] + time[8:10] + time[11:13] + time[14:16] + time[17:]
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError
+    datetime.fromisoformat(time)
+
+
+def _validate_amount(amount: str, *, positive: bool) -> float:
+    value: float = float(amount)
+    if not math.isfinite(value):
+        raise ValueError("amount must be a finite number")
+    if positive and value <= 0:
+        raise ValueError("amount must be positive")
+    if round(value, 2) != value:
+        raise ValueError("amount must have at most 2 decimals")
+    return value
+
+
+def _validate_posting(record: Record) -> list[str]:
+    """Checks the fields of a posting, not its account."""
+    errors: list[str] = []
+    if record.get("kind") not in ("d", "w"):
+        errors.append("kind must be 'd' or 'w'")
+    try:
+        _validate_time(record.get("time") or "")
+    except ValueError:
+        errors.append(f"time must be of {TIME_FORMAT} format")
+    try:
+        _validate_amount(record.get("amount"), positive=True)
+    except (ValueError, TypeError) as error:
+        errors.append(str(error))
+    return errors
+
+
+def _validate_chunk(chunk: list[tuple[int, Record]], users: dict | None = None,
+                    accounts: dict | None = None) -> list[tuple[int, str]]:
+    """Checks a chunk against the book (or given `users` and `accounts`
+    registries) and against itself.
+    Returns `(line number, error)` pairs, empty if the chunk is valid.
+    """
+    users = User.users if users is None else users
+    accounts = Account.accounts if accounts is None else accounts
+    errors: list[tuple[int, str]] = []
+    new_users: set[str] = set()
+    new_accounts: set[str] = set()
+    new_owners: set[str] = set()
+    for line_number, record in chunk:
+        record_type: str = record.get("type")
+        record_id: str = record.get("id")
+        if not record_id:
+            errors.append((line_number, "missing id"))
+        elif record_type == "user":
+            if record_id in users or record_id in new_users:
+                errors.append((line_number, f"user '{record_id}' already exists"))
+            new_users.add(record_id)
+        elif record_type == "account":
+            owner_id: str = record.get("owner_id")
+            owner: User | None = users.get(owner_id)
+            if record_id in accounts or record_id in new_accounts:
+                errors.append((line_number, f"account '{record_id}' already exists"))
+            elif owner is None and owner_id not in new_users:
+                errors.append((line_number, f"client '{owner_id}' does not exist"))
+            elif hasattr(owner, "account") or owner_id in new_owners:
+                errors.append((line_number, f"client '{owner_id}' already has an account"))
+            try:
+                _validate_amount(record.get("amount") or 0, positive=False)
+            except ValueError as error:
+                errors.append((line_number, str(error)))
+            new_accounts.add(record_id)
+            new_owners.add(owner_id)
+        elif record_type == "posting":
+            if record_id not in accounts and record_id not in new_accounts:
+                errors.append((line_number, f"account '{record_id}' does not exist"))
+            errors.extend((line_number, error) for error in _validate_posting(record))
+        else:
+            errors.append((line_number, f"unknown record type '{record_type}'"))
+    return errors
+
+
+def print_errors(errors: list[tuple[int, str]], limit: int = 10) -> None:
+    for line_number, error in errors[:limit]:
+        rprint(f"[red]line {line_number}: [white]{error}")
+    if len(errors) > limit:
+        rprint(f"[red]...and {len(errors) - limit} more errors.")
+
+
+def _apply_chunk(chunk: list[tuple[int, Record]]) -> tuple[int, int, int]:
+    """Creates users, accounts and postings of a validated chunk.
+
+    Postings are grouped by account, so every account's balance
+    and history are updated once per chunk.
+    """
+    users: int = 0
+    accounts: int = 0
+    postings: dict[str, list[tuple[str, str, float, str]]] = {}
+    for _, record in chunk:
+        record_type: str = record["type"]
+        if record_type == "user":
+            User(record["id"])
+            users += 1
+        elif record_type == "account":
+            Account(record["id"], float(record.get("amount") or 0), owner_id=record["owner_id"])
+            accounts += 1
+        else:
+            postings.setdefault(record["id"], []).append((
+                record["time"],
+                record["kind"],
+                float(record["amount"]),
+                record.get("description") or "",
+            ))
+    for account_id, operations in postings.items():
+        Account.accounts[account_id]._post_many(operations)
+    return users, accounts, sum(len(operations) for operations in postings.values())
+
+
+def import_records(records: Iterable[tuple[int, Record]],
+                    chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple[int, int, int]:
+    """Imports records chunk by chunk.
+
+    Every chunk is validated as a whole before anything is created,
+    so a bad record leaves the book as it was after the previous chunk.
+    Returns the number of imported users, accounts and postings.
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk size must be positive, got {chunk_size}")
+    totals: list[int] = [0, 0, 0]
+    records = iter(records)
+    while True:
+        try:
+            chunk: list[tuple[int, Record]] = list(itertools.islice(records, chunk_size))
+        except BulkImportError:
+            # An unreadable record, reported by `read_records`.
+            rprint(f"Imported {totals[0]} users, {totals[1]} accounts, {totals[2]} postings before the error.")
+            raise
+        if not chunk:
+            break
+        errors: list[tuple[int, str]] = _validate_chunk(chunk)
+        if errors:
+            print_errors(errors)
+            rprint(f"Imported {totals[0]} users, {totals[1]} accounts, {totals[2]} postings before the error.")
+            raise BulkImportError
+        for index, count in enumerate(_apply_chunk(chunk)):
+            totals[index] += count
+    return tuple(totals)
+
+
+def load(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple[int, int, int]:
+    """Imports a book file. See `import_records`."""
+    return import_records(read_records(path), chunk_size)
+
+
+def dump(path: str) -> int:
+    """Exports the current book to a file.
+    Returns the number of written records.
+    """
+    return write_records(path, iter_book())
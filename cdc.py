@@ -0,0 +1,218 @@
+"""Change-data-capture stream of the book.
+
+Every change of the book (see `user.subscribe`) is published to
+a bounded in-process ring buffer, `feed`, as an event with an offset.
+Offsets grow by one per event, so a consumer remembers the offset
+of the next event it needs and resumes from it.
+
+Publishing is O(1) and never waits for subscribers: a subscriber that
+falls more than `capacity` events behind gets `FeedOverflowError` and
+has to resynchronize (e.g. from `export_book`) before it goes on
+from `feed.oldest_offset`. Offsets start from 0 again with the process,
+so an offset ahead of the feed (saved before a restart) gets
+`FeedOffsetError` and needs a resynchronization too.
+
+Events are dicts with "offset" and "event" keys plus:
+    *user_created, user_deleted: "user_id".
+    *account_created: "account_id", "owner_id", "balance".
+    *account_deleted: "account_id", "owner_id".
+    *posted (one per operation): "account_id", "time", "kind", "amount",
+        "description", "balance".
+    *history_replaced: "account_id", "operations", "balance".
+    *book_cleared: nothing.
+"""
+import asyncio
+import json
+import socketserver
+import threading
+from typing import AsyncIterator, Iterator
+from exceptions import FeedOffsetError, FeedOverflowError
+from user import subscribe
+
+
+DEFAULT_CAPACITY: int = 100000
+DEFAULT_BATCH: int = 1000
+# Upper bound of a batch, whatever a subscriber asks for.
+MAX_BATCH: int = 10000
+
+
+def _event(offset: int, name: str, data: tuple) -> dict:
+    event: dict = {"offset": offset, "event": name}
+    if name in ("user_created", "user_deleted"):
+        event["user_id"] = data[0]
+    elif name == "account_created":
+        event.update(account_id=data[0], owner_id=data[1], balance=data[2])
+    elif name == "account_deleted":
+        event.update(account_id=data[0], owner_id=data[1])
+    elif name == "posted":
+        time, kind, amount, description, balance = data[1]
+        event.update(account_id=data[0], time=time, kind=kind, amount=amount,
+                        description=description, balance=balance)
+    elif name == "history_replaced":
+        event.update(account_id=data[0], operations=data[1], balance=data[2])
+    return event
+
+
+class ChangeFeed:
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity: int = capacity
+        # Events are kept as `(name, data)` and turned into dicts
+        # only when read, publishing must stay cheap.
+        self._buffer: list[tuple[str, tuple] | None] = [None] * capacity
+        self.next_offset: int = 0
+        self._condition = threading.Condition()
+
+    @property
+    def oldest_offset(self) -> int:
+        return max(0, self.next_offset - self.capacity)
+
+    def publish(self, name: str, data: tuple) -> None:
+        self.publish_many(name, (data,))
+
+    def publish_many(self, name: str, datas) -> None:
+        with self._condition:
+            for data in datas:
+                # Offset first: readers copying without the lock see
+                # an entry as overwritten before it is.
+                self.next_offset += 1
+                self._buffer[(self.next_offset - 1) % self.capacity] = (name, data)
+            self._condition.notify_all()
+
+    def read(self, offset: int, max_events: int = DEFAULT_BATCH,
+                timeout: float | None = 0) -> list[dict]:
+        """Events starting at `offset`, at most `max_events` (capped
+        by `MAX_BATCH`). Waits up to `timeout` seconds (forever if None)
+        for at least one.
+        """
+        max_events = max(1, min(max_events, MAX_BATCH))
+        with self._condition:
+            if offset > self.next_offset:
+                raise FeedOffsetError(f"offset {offset} is ahead of the feed, next is {self.next_offset}")
+            if timeout != 0:
+                self._condition.wait_for(lambda: self.next_offset > offset, timeout)
+            self._check(offset)
+            end: int = min(self.next_offset, offset + max_events)
+        if end <= offset:
+            return []
+        # Copied without the lock, which publishers need, and checked
+        # afterwards: entries are overwritten oldest first, so if the
+        # first one is still there, all of them are.
+        start: int = offset % self.capacity
+        entries: list[tuple[str, tuple]] = self._buffer[start:start + end - offset]
+        if len(entries) < end - offset:
+            entries += self._buffer[:end - offset - len(entries)]
+        self._check(offset)
+        return [_event(offset + number, *entry) for number, entry in enumerate(entries)]
+
+    def _check(self, offset: int) -> None:
+        if offset < self.oldest_offset:
+            raise FeedOverflowError(f"offset {offset} is overwritten, oldest is {self.oldest_offset}")
+
+    def subscribe(self, offset: int | None = None) -> "Subscription":
+        """Subscription from `offset`, from the next event by default."""
+        return Subscription(self, self.next_offset if offset is None else offset)
+
+
+class Subscription:
+    """Resumable reader of a feed, delivering events in batches.
+
+    Iterating over it (sync or async) yields non-empty batches forever.
+    """
+    def __init__(self, feed: ChangeFeed, offset: int, max_events: int = DEFAULT_BATCH) -> None:
+        self.feed: ChangeFeed = feed
+        self.offset: int = offset
+        self.max_events: int = max_events
+
+    def poll(self, timeout: float | None = 0) -> list[dict]:
+        """Next batch, empty if nothing was published within `timeout`."""
+        events: list[dict] = self.feed.read(self.offset, self.max_events, timeout)
+        self.offset += len(events)
+        return events
+
+    def __iter__(self) -> Iterator[list[dict]]:
+        while True:
+            yield self.poll(timeout=None)
+
+    async def __aiter__(self) -> AsyncIterator[list[dict]]:
+        while True:
+            # Waiting happens in a thread, the event loop isn't blocked.
+            # The offset moves only once the batch is delivered here,
+            # a cancelled wait leaves it for the next one.
+            events: list[dict] = await asyncio.to_thread(self.feed.read, self.offset, self.max_events, 1.0)
+            self.offset += len(events)
+            if events:
+                yield events
+
+
+feed = ChangeFeed()
+
+
+def _on_change(event: str, record, previous) -> None:
+    if event in ("user_created", "user_deleted"):
+        feed.publish(event, (record.id,))
+    elif event == "account_created":
+        feed.publish(event, (record.id, record.owner.id, str(record.balance)))
+    elif event == "account_deleted":
+        feed.publish(event, (record.id, record.owner.id))
+    elif event == "posted":
+        # Still under the account's write lock, `history` is consistent.
+        feed.publish_many(event, ((record.id, operation) for operation in record.history[previous[1]:]))
+    elif event == "history_replaced":
+        feed.publish(event, (record.id, len(record.history), str(record.balance)))
+    elif event == "book_cleared":
+        feed.publish(event, ())
+
+subscribe(_on_change)
+
+
+class _FeedHandler(socketserver.StreamRequestHandler):
+    """Client sends one line: `<offset>|latest [<batch size>]`
+    (at most `MAX_BATCH`), then receives events as JSON lines.
+    If it falls behind, it receives
+    `{"event": "overflow", "oldest_offset": ...}`, if its request is
+    invalid or its offset is ahead of the feed,
+    `{"event": "error", "message": ...}`; then the connection is closed.
+    """
+    def _send(self, events: list[dict]) -> None:
+        self.wfile.write("".join(json.dumps(event) + "\n" for event in events).encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        line: str = self.rfile.readline().decode("utf-8", errors="replace")
+        request: list[str] = line.split()
+        try:
+            try:
+                offset: int | None = None if not request or request[0] == "latest" else int(request[0])
+                max_events: int = int(request[1]) if len(request) > 1 else DEFAULT_BATCH
+            except ValueError:
+                error: str = f"expected `<offset>|latest [<batch size>]`, got {line.strip()!r}"
+                self._send([{"event": "error", "message": error}])
+                return
+            subscription: Subscription = self.server.feed.subscribe(offset)
+            subscription.max_events = max(1, min(max_events, MAX_BATCH))
+            while True:
+                events: list[dict] = subscription.poll(timeout=1.0)
+                if events:
+                    self._send(events)
+        except FeedOverflowError:
+            self._send([{"event": "overflow", "oldest_offset": self.server.feed.oldest_offset}])
+        except FeedOffsetError as error:
+            self._send([{"event": "error", "message": str(error)}])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FeedServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int], change_feed: ChangeFeed = feed) -> None:
+        super().__init__(address, _FeedHandler)
+        self.feed: ChangeFeed = change_feed
+
+
+def serve_in_background(address: tuple[str, int], change_feed: ChangeFeed = feed) -> FeedServer:
+    """Starts a feed server in a daemon thread."""
+    server = FeedServer(address, change_feed)
+    threading.Thread(target=server.serve_forever, name="change-feed", daemon=True).start()
+    return server
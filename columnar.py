@@ -0,0 +1,139 @@
+"""Columnar export of account histories for analysis.
+
+Histories are exported as contiguous typed columns (`array.array`),
+one value per operation and no Python object per row:
+    *account: int32, index of the account in `account_ids`.
+    *time: int64, seconds since the epoch, the history time read as UTC.
+    *kind: uint8, `ord("d")` for deposits, `ord("w")` for withdrawals.
+    *amount: int64, amount in cents.
+    *balance: int64, balance after the operation in cents.
+Descriptions are left out on purpose, they are per-row strings.
+Initial balances of the accounts, in cents, are in the int64 `initial`
+column, indexed like `account_ids`. Histories may be exported from
+a moment on (`since`): the operations before it are left out and make
+the initial balance, their times are compared as strings, never parsed.
+
+Columns support the buffer protocol, so they are wrapped by NumPy or
+Arrow without copying (`Columns.to_numpy`, `Columns.to_arrow`), e.g.
+    pandas.DataFrame(columnar.book_columns().to_numpy())
+NumPy and pyarrow are optional, they're imported only when asked for.
+"""
+import calendar
+import itertools
+from array import array
+from datetime import datetime
+from typing import Iterable
+from user import Account, Operation
+
+
+TYPECODES: dict[str, str] = {"account": "i", "time": "q", "kind": "B", "amount": "q", "balance": "q"}
+
+
+class Columns:
+    def __init__(self) -> None:
+        self.account_ids: list[str] = []
+        self.initial: array = array(TYPECODES["balance"])
+        self.account: array = array(TYPECODES["account"])
+        self.time: array = array(TYPECODES["time"])
+        self.kind: array = array(TYPECODES["kind"])
+        self.amount: array = array(TYPECODES["amount"])
+        self.balance: array = array(TYPECODES["balance"])
+        # Starts of the minutes met so far, shared by all accounts:
+        # postings come in bursts, so most times are converted with one `int`.
+        self._minutes: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def add(self, account: Account, since: str | None = None) -> None:
+        """Appends the account's history, as of now, leaving out
+        the leading operations made up to `since` (history time format).
+        """
+        index: int = len(self.account_ids)
+        self.account_ids.append(account.id)
+        initial: int = round(float(account._initial_balance) * 100)
+        operations: list[Operation] = list(account.snapshot().history)
+        if since is not None:
+            start: int = 0
+            while start < len(operations) and operations[start][0] <= since:
+                cents: int = round(operations[start][2] * 100)
+                initial += cents if operations[start][1] == "d" else -cents
+                start += 1
+            del operations[:start]
+        self.initial.append(initial)
+        # Columns are filled column by column, with as little done
+        # per operation in Python as possible.
+        minutes: dict[str, int] = self._minutes
+        times: list[int] = []
+        for operation in operations:
+            time: str = operation[0]
+            minute: int | None = minutes.get(time[:16])
+            if minute is None:
+                minute = minutes[time[:16]] = calendar.timegm(datetime.fromisoformat(time[:16]).timetuple())
+            times.append(minute + int(time[17:19]))
+        self.time.extend(times)
+        kinds: str = "".join([operation[1] for operation in operations])
+        self.kind.frombytes(kinds.encode("ascii"))
+        cents: list[int] = [round(operation[2] * 100) for operation in operations]
+        self.amount.extend(cents)
+        # Running balance from the initial one, which is not a row.
+        balances = itertools.accumulate(
+            [amount if kind == "d" else -amount for kind, amount in zip(kinds, cents)], initial=initial)
+        next(balances)
+        self.balance.extend(balances)
+        self.account.extend(array(TYPECODES["account"], [index]) * len(operations))
+
+    def to_numpy(self) -> dict:
+        """Columns as NumPy arrays sharing memory with this object;
+        `time` is `datetime64[s]`, `kind` is `S1` (b"d" or b"w").
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("`to_numpy` requires NumPy: pip install numpy") from None
+        return {
+            "account": numpy.frombuffer(self.account, dtype=numpy.int32),
+            "time": numpy.frombuffer(self.time, dtype="datetime64[s]"),
+            "kind": numpy.frombuffer(self.kind, dtype="S1"),
+            "amount": numpy.frombuffer(self.amount, dtype=numpy.int64),
+            "balance": numpy.frombuffer(self.balance, dtype=numpy.int64),
+        }
+
+    def to_arrow(self):
+        """Columns as a `pyarrow.Table` over this object's buffers;
+        `account` is dictionary-encoded with the account IDs.
+        """
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("`to_arrow` requires pyarrow: pip install pyarrow") from None
+
+        def column(name: str, data_type):
+            return pyarrow.Array.from_buffers(data_type, len(self), [None, pyarrow.py_buffer(getattr(self, name))])
+
+        account = pyarrow.DictionaryArray.from_arrays(column("account", pyarrow.int32()),
+                                                        pyarrow.array(self.account_ids, pyarrow.string()))
+        return pyarrow.table({
+            "account": account,
+            "time": column("time", pyarrow.timestamp("s")),
+            "kind": column("kind", pyarrow.binary(1)),
+            "amount": column("amount", pyarrow.int64()),
+            "balance": column("balance", pyarrow.int64()),
+        })
+
+
+def account_columns(account: Account) -> Columns:
+    columns = Columns()
+    columns.add(account)
+    return columns
+
+
+def book_columns(accounts: Iterable[Account] | None = None, since: str | None = None) -> Columns:
+    """Columns of `accounts` (all by default), account by account,
+    every account's operations in the order of its history.
+    See `Columns.add` for `since`.
+    """
+    columns = Columns()
+    for account in list(accounts if accounts is not None else Account.accounts.values()):
+        columns.add(account, since)
+    return columns
@@ -1,5 +1,7 @@
 import functools
+import time
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from rich import print as rprint
 from rich.console import Console
 from rich.table import Table
@@ -9,8 +11,21 @@ from exceptions import (
     AccountNotFoundError,
     AccountDoesNotExistError,
     WrongAmountFormat,
+    IntegrityError,
+    OrderNotFoundError,
 )
-from user import Account, User, _Balance
+import accrual
+import bulk
+import cdc
+import integrity
+import orders
+import replay
+import statements
+from ledger import ledger
+from orders import order_book
+from profiler import profiler
+from scheduler import scheduler
+from user import Account, AccountSnapshot, User, _Balance, memory_usage
 
 
 console = Console()
@@ -67,8 +82,7 @@ def deposit(client_id: str, amount: float, description: str = "ATM Deposit"):
     
     client: User = User.users.get(client_id)
     deposit_time: str = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    client.account.balance += amount
-    client.account.history.append((deposit_time, "d", amount, description, str(client.account.balance)))
+    client.account._post(deposit_time, "d", amount, description)
     print(f"{client_id} depositted ${amount} for '{description}'.")
 
 @check_validity
@@ -83,8 +97,7 @@ def withdraw(client_id: str, amount: float, description: str = "ATM Withdrawal")
     """
     client: User = User.users.get(client_id)
     withdraw_time: str = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    client.account.balance -= amount
-    client.account.history.append((withdraw_time, "w", amount, description, str(client.account.balance)))
+    client.account._post(withdraw_time, "w", amount, description)
     print(f"{client_id} withdrew ${amount} for '{description}'.")
 
 def show_bank_statement(client_id: str, since: datetime = None, till: datetime = None):
@@ -144,6 +157,8 @@ def show_bank_statement(client_id: str, since: datetime = None, till: datetime =
     if not hasattr(client, "account"):
         rprint(f"Client '[bold]{client_id}' [red]doesn't have an account yet!")
     else:
+        # Postings made while the table is rendered are not shown.
+        snapshot: AccountSnapshot = client.account.snapshot()
         total_deposit: float = _Balance('0')
         total_withdraw: float = _Balance('0')
         final_balance: float = _Balance(client.account._initial_balance)
@@ -151,7 +166,7 @@ def show_bank_statement(client_id: str, since: datetime = None, till: datetime =
         table = Table("Date", "Description", "Withdrawals", "Deposits", "Balance")
         table.add_row("", "Previous balance", "", "", f"${client.account._initial_balance}", end_section=True)
 
-        for operation in client.account.history:
+        for operation in snapshot.history:
             if since < datetime.strptime(operation[0], "%Y-%m-%d %H:%M:%S") < till:
                 if operation[1] == "d":
                     table.add_row(operation[0], operation[3], "", f"${operation[2]}", str(operation[4]))
@@ -201,13 +216,8 @@ def delete_user(client_id: str):
     client: User = User.users.get(client_id)
     if client:
         rprint(f"[red]Deleted user {client}")
-        if hasattr(client, "account"):
-            # technically it'd be better architecture-wise to implement
-            # observer class to detect changes in `Users.user` to delete
-            # the corresponding account on user deletion but I don't
-            # have neither knowledge nor time to do it
-            Account.accounts.pop(client.account.id)
-        User.users.pop(client_id)
+        # Deletes the account too, see `User._delete`.
+        client._delete()
     else:
         rprint(f"[red]Client not found! Try again.")
         raise ClientNotFoundError
@@ -221,7 +231,7 @@ def delete_account(account_id: str):
     account: Account = Account.accounts.get(account_id)
     if account:
         rprint(f"[red]Deleted account {account}")
-        Account.accounts.pop(account_id)
+        account._delete()
     else:
         rprint(f"[red]Account not found! Try again.")
         raise AccountNotFoundError
@@ -230,13 +240,364 @@ def display_users():
     """Description: Displays all registered (created) users.
         Args: None
     """
-    rprint(User.users)
+    # Copying the registry is atomic, users created meanwhile don't break printing.
+    rprint(dict(User.users))
 
 def display_accounts():
     """Description: Displays all created accounts.
         Args: None
     """
-    rprint(Account.accounts)
+    rprint(dict(Account.accounts))
+
+def import_book(path: str, chunk_size: int = bulk.DEFAULT_CHUNK_SIZE):
+    """Description: Imports users, accounts and their postings from a file. Example: `import_book book.csv`
+        Args:
+            *path (text): path to a `.csv` or `.jsonl` file, e.g. the one made by `export_book`.
+            *chunk_size (int, optional): number of records validated and imported at once. [default=10000]
+                If a record is invalid, the chunk containing it is not imported, previous ones are kept.
+    """
+    try:
+        chunk_size = int(chunk_size)
+    except ValueError:
+        chunk_size = 0
+    if chunk_size < 1:
+        rprint("[red]chunk_size [white]must be a positive integer! Try again.")
+        raise ValueError
+    started: float = time.perf_counter()
+    users, accounts, postings = bulk.load(path, chunk_size)
+    rprint(f"Imported [bold]{users} [white]users, [bold]{accounts} [white]accounts, "
+            + f"[bold]{postings} [white]postings in {time.perf_counter() - started:.2f}s.")
+
+def export_book(path: str):
+    """Description: Exports all users, accounts and their postings to a file. Example: `export_book book.jsonl`
+        Args:
+            *path (text): path to a `.csv` or `.jsonl` file. Existing file is overwritten.
+    """
+    started: float = time.perf_counter()
+    records: int = bulk.dump(path)
+    rprint(f"Exported [bold]{records} [white]records in {time.perf_counter() - started:.2f}s.")
+
+def replay_book(path: str, as_of: str = None, workers: int = 0):
+    """Description: Rebuilds all users, accounts and their histories from a file, in parallel.
+            CAUTION! current users and accounts are replaced.
+        Args:
+            *path (text): path to a `.csv` or `.jsonl` file made by `export_book`.
+            *as_of (date, optional): rebuild the state as of this moment, postings after it are skipped.
+                Formats (no quotes): YYYY-MM-DD (end of the day); YYYY-MM-DDTHH:MinMin:SS
+                To skip this parameter, enter `-`.
+            *workers (int, optional): number of worker processes, 1 replays without them. [default=number of cores]
+            Examples:
+                `replay_book book.jsonl`
+                `replay_book book.jsonl 2022-10-10`
+                `replay_book book.jsonl - 4`
+    """
+    try:
+        as_of = replay.normalize_as_of(as_of) if as_of and as_of != "-" else None
+    except ValueError:
+        rprint("[red]as_of [white]format should be of following:\n"
+                + "\t*YYYY-MM-DD\n\t*YYYY-MM-DDTHH:MinMin:SS")
+        raise
+    started: float = time.perf_counter()
+    users, accounts, postings = replay.replay(path, int(workers), as_of)
+    rprint(f"Replayed [bold]{users} [white]users, [bold]{accounts} [white]accounts, "
+            + f"[bold]{postings} [white]postings in {time.perf_counter() - started:.2f}s.")
+
+def profile(action: str, argument: str = None):
+    """Description: Profiles executed commands without restarting the program.
+        Args:
+            *action (text): one of:
+                `start` - starts profiling, `argument` is the mode. [default="sample"]
+                    Modes: `sample` (sampling, flamegraph-ready collapsed stacks), `trace` (cProfile),
+                    `alloc` (tracemalloc per command) or a combination, e.g. `sample+alloc`.
+                `stop` - stops profiling, collected data is kept.
+                `dump` - shows per-command timings and writes reports to files starting with `argument`. [default="profile"]
+            Examples:
+                `profile start trace+alloc`
+                `profile dump /tmp/slow_statements`
+            (Profiling can also be started with `BANK_PROFILE=<mode>` environment variable.)
+    """
+    if action == "start":
+        try:
+            profiler.start(argument or "sample")
+        except ValueError:
+            rprint("[red]mode [white]must be `sample`, `trace`, `alloc` or a combination, e.g. `sample+alloc`.")
+            raise
+        rprint(f"Profiling started: [bold]{argument or 'sample'}")
+    elif action == "stop":
+        profiler.stop()
+        rprint("Profiling stopped.")
+    elif action == "dump":
+        table = Table("Command", "Calls", "Total (s)", "Mean (ms)")
+        for name, (calls, total) in sorted(profiler.timings.items(), key=lambda item: -item[1][1]):
+            table.add_row(name, str(calls), f"{total:.3f}", f"{total / calls * 1000:.3f}")
+        console.print(table)
+        for path in profiler.dump(argument or "profile"):
+            rprint(f"Written [bold]{path}")
+    else:
+        rprint("[red]action [white]must be one of `start`, `stop`, `dump`.")
+        raise ValueError
+
+def scheduler_stats():
+    """Description: Displays queue sizes, shed commands and latencies per priority class of the scheduler.
+        Args: None
+    """
+    if not scheduler.running:
+        rprint("[blue]Scheduler is not running, commands are executed directly.")
+    table = Table("Class", "Queued", "Running", "Completed", "Shed", "p50 (ms)", "p99 (ms)")
+    for command_class, stats in scheduler.report().items():
+        table.add_row(
+            command_class,
+            str(stats["queued"]), str(stats["running"]), str(stats["completed"]), str(stats["shed"]),
+            f"{stats['p50'] * 1000:.3f}", f"{stats['p99'] * 1000:.3f}",
+        )
+    console.print(table)
+
+def create_order(client_id: str, kind: str, amount: float, first_due: str,
+                    period: str = "once", description: str = "Standing order"):
+    """Description: Schedules a posting to a client's account, once or recurring.
+            Orders are posted in batches by the ledger clock when they are due.
+        Args:
+            *client_id (text): client's ID, whose account the order is posted to.
+            *kind (text): `deposit` or `withdraw`.
+            *amount (float): amount of money. Format must include pennies after a 'dot', e.g.: 100.12 OR 0.99.
+            *first_due (date): when the order is due for the first time. Formats (no quotes):
+                YYYY-MM-DD (start of the day); YYYY-MM-DDTHH:MinMin:SS
+            *period (text, optional): `once`, `daily`, `weekly` or `monthly`. [default=once]
+            *description (text, optional): description of the postings. [default="Standing order"]
+            Examples:
+                `create_order STYB227 deposit 2500 2022-11-01 monthly "Salary"`
+                `create_order STYB227 withdraw 15.99 2022-10-15T09:00:00`
+    """
+    client: User = User.users.get(client_id)
+    if not client:
+        rprint("[red]Client not found! Try again.")
+        raise ClientNotFoundError
+    elif not hasattr(client, "account"):
+        rprint("[red]Client doesn't have a bank account! Try again.")
+        raise AccountDoesNotExistError
+    if kind not in ("deposit", "withdraw"):
+        rprint("[red]kind [white]must be `deposit` or `withdraw`.")
+        raise ValueError
+    try:
+        amount = float(amount)
+    except ValueError:
+        rprint(f"[red]amount [white]must be a numerical value.")
+        raise
+    if amount <= 0:
+        rprint("[red]amount [white]must be positive number ([red]amount [white]> 0)! Try again.")
+        raise NegativeAmountError
+    elif round(amount, 2) != amount:
+        rprint("[red]amount [white]must have 2 floating point decimals (e.g. `10.95`) or none (e.g. `500`)! Try again.")
+        raise WrongAmountFormat
+    try:
+        due: datetime = datetime.fromisoformat(first_due.replace("/", "-"))
+    except ValueError:
+        rprint("[red]first_due [white]format should be of following:\n"
+                + "\t*YYYY-MM-DD\n\t*YYYY-MM-DDTHH:MinMin:SS")
+        raise
+    if period not in orders.PERIODS:
+        rprint(f"[red]period [white]should be one of: {', '.join(orders.PERIODS)}.")
+        raise ValueError
+    order: orders.StandingOrder = order_book.add(client_id, kind[0], amount, due, period, description)
+    rprint(f"Created standing order {order}")
+
+def cancel_order(order_id: int):
+    """Description: Cancels a standing order.
+        Args:
+            *order_id (int): ID of the order, as shown by `display_orders`.
+    """
+    try:
+        order: orders.StandingOrder | None = order_book.cancel(int(order_id))
+    except ValueError:
+        rprint("[red]order_id [white]must be an integer.")
+        raise
+    if order is None:
+        rprint(f"[red]Standing order not found! Try again.")
+        raise OrderNotFoundError
+    rprint(f"[red]Cancelled standing order {order}")
+
+def display_orders():
+    """Description: Displays all pending standing orders.
+        Args: None
+    """
+    table = Table("ID", "Client", "Kind", "Amount", "Next due", "Period", "Description")
+    for order in sorted(list(order_book.orders.values()), key=lambda order: order.due):
+        table.add_row(
+            str(order.id), order.client_id, "deposit" if order.kind == "d" else "withdraw",
+            f"${order.amount}", f"{order.due:%Y-%m-%d %H:%M:%S}", order.period, order.description,
+        )
+    console.print(table)
+
+def run_orders():
+    """Description: Posts all standing orders due by now, without waiting for the ledger clock.
+        Args: None
+    """
+    started: float = time.perf_counter()
+    postings, accounts = order_book.run()
+    rprint(f"Posted [bold]{postings} [white]standing orders to [bold]{accounts} [white]accounts "
+            + f"in {time.perf_counter() - started:.2f}s.")
+
+def ledger_summary():
+    """Description: Displays bank-wide and today's totals: deposits, withdrawals,
+            money on all accounts and the number of overdrawn accounts.
+            Totals are kept up to date on every change, nothing is recomputed.
+        Args: None
+    """
+    today: str = datetime.now().strftime("%Y-%m-%d")
+    table = Table("Period", "Deposits", "Withdrawals", "Outstanding", "Overdrawn accounts", "Accounts")
+    for period, totals in (("All time", ledger.summary()), (today, ledger.summary(today))):
+        table.add_row(
+            period,
+            *(str(_Balance(totals[total] / 100)) for total in ("deposits", "withdrawals", "outstanding")),
+            str(totals["overdrawn"]),
+            str(totals.get("accounts", "")),
+        )
+    console.print(table)
+
+def accrue_interest(since: str, till: str, rate: float,
+                    overdraft_rate: float = 0, fee: float = 0):
+    """Description: Accrues interest and fees to all accounts for a period.
+            Interest is computed from the time-weighted balance over the period
+            and posted with fees in one batch per account.
+            Accounts already accrued for an overlapping period are skipped, so a repeated run charges nothing twice.
+            Example: `accrue_interest 2022-10-01 2022-11-01 3.5 20 1.99`
+        Args:
+            *since (date): first day of the period. Formats (no quotes): YYYY-MM-DD; YYYY/MM/DD
+            *till (date): day after the last day of the period. Formats (no quotes): YYYY-MM-DD; YYYY/MM/DD
+            *rate (float): annual interest rate on positive balance, in percent.
+            *overdraft_rate (float, optional): annual interest rate on negative balance, in percent. [default=0]
+            *fee (float, optional): flat fee charged from every account. [default=0]
+    """
+    try:
+        since_date: datetime = datetime.fromisoformat(since.replace("/", "-"))
+        till_date: datetime = datetime.fromisoformat(till.replace("/", "-"))
+    except ValueError:
+        rprint("[red]since [white]and [red]till [white]format should be YYYY-MM-DD or YYYY/MM/DD.")
+        raise
+    if till_date <= since_date:
+        rprint("[red]till [white]must be later than [red]since[white]! Try again.")
+        raise ValueError
+    try:
+        rate, overdraft_rate, fee = (Decimal(str(value)) for value in (rate, overdraft_rate, fee))
+    except InvalidOperation:
+        rprint(f"[red]rate[white], [red]overdraft_rate [white]and [red]fee [white]must be numerical values.")
+        raise ValueError
+    if min(rate, overdraft_rate, fee) < 0:
+        rprint("[red]rate[white], [red]overdraft_rate [white]and [red]fee [white]can't be negative! Try again.")
+        raise NegativeAmountError
+
+    started: float = time.perf_counter()
+    totals: dict[str, int] = accrual.accrue(since_date, till_date, rate / 100, overdraft_rate / 100, fee)
+    rprint(f"Accrued to [bold]{totals['accounts']} [white]accounts in {time.perf_counter() - started:.2f}s: "
+            + f"interest ${totals['interest'] / 100}, overdraft interest ${totals['overdraft'] / 100}, "
+            + f"fees ${totals['fees'] / 100}. Skipped [bold]{totals['skipped']} [white]accounts already accrued "
+            + "for an overlapping period.")
+
+def generate_statements(out_dir: str, since: str, till: str, file_format: str = "txt", workers: int = 0):
+    """Description: Writes statements of all accounts for a period to files, in parallel.
+            Every account gets its own file `<out_dir>/<account_id>.<file_format>`.
+            Statements already written are skipped, so an interrupted run is resumed by repeating it.
+            Example: `generate_statements statements/2022-10 2022-10-01 2022-11-01 csv`
+        Args:
+            *out_dir (text): directory for the statements, created if missing.
+            *since (date): first day of the period. Formats (no quotes): YYYY-MM-DD; YYYY/MM/DD
+            *till (date): day after the last day of the period. Formats (no quotes): YYYY-MM-DD; YYYY/MM/DD
+            *file_format (text, optional): `txt`, `csv` or `json`. [default=txt]
+            *workers (int, optional): number of worker processes, 1 writes without them. [default=number of cores]
+    """
+    try:
+        since_date: datetime = datetime.fromisoformat(since.replace("/", "-"))
+        till_date: datetime = datetime.fromisoformat(till.replace("/", "-"))
+    except ValueError:
+        rprint("[red]since [white]and [red]till [white]format should be YYYY-MM-DD or YYYY/MM/DD.")
+        raise
+    if till_date <= since_date:
+        rprint("[red]till [white]must be later than [red]since[white]! Try again.")
+        raise ValueError
+    if file_format not in statements.FORMATS:
+        rprint(f"[red]file_format [white]should be one of: {', '.join(statements.FORMATS)}.")
+        raise ValueError
+
+    started: float = time.perf_counter()
+    written, skipped = statements.generate(
+        out_dir, f"{since_date:%Y-%m-%d %H:%M:%S}", f"{till_date:%Y-%m-%d %H:%M:%S}", file_format, int(workers)
+    )
+    rprint(f"Written [bold]{written} [white]statements ([bold]{skipped} [white]already written) "
+            + f"in {time.perf_counter() - started:.2f}s.")
+
+def verify_root():
+    """Description: Shows the bank-wide integrity root of the book.
+        Args: None
+    """
+    rprint(f"Integrity root of [bold]{len(Account.accounts)} [white]accounts: [bold]{integrity.tree.root().hex()}")
+
+def verify(path: str):
+    """Description: Compares the book with a backup and displays accounts that differ.
+            Example: `verify backup.jsonl`
+        Args:
+            *path (text): `.csv` or `.jsonl` file made by `export_book`.
+    """
+    other, digests = integrity.book_digests(bulk.read_records(path))
+    differences = integrity.diverging_accounts(other, digests)
+    if not differences:
+        rprint(f"[green]Book matches {path}[white]: root [bold]{other.root().hex()}")
+        return
+    table = Table("Account", "Book", path)
+    for account_id, local, theirs in differences:
+        table.add_row(account_id, local.hex() if local else "missing", theirs.hex() if theirs else "missing")
+    console.print(table)
+    rprint(f"[red]{len(differences)} accounts differ from {path}!")
+    raise IntegrityError
+
+def verify_account(account_id: str):
+    """Description: Checks that account's history, balance and history digest agree.
+        Args:
+            *account_id (text): ID of the account to check.
+    """
+    account: Account = Account.accounts.get(account_id)
+    if not account:
+        rprint(f"[red]Account not found! Try again.")
+        raise AccountNotFoundError
+    problems: list[str] = integrity.check_account(account)
+    if problems:
+        for problem in problems:
+            rprint(f"[red]{problem}")
+        raise IntegrityError
+    rprint(f"[green]Account {account_id} is consistent[white]: digest [bold]{account.digest.hex()}")
+
+def change_feed():
+    """Description: Shows offsets of the change feed of all changes in the book.
+        Args: None
+    """
+    rprint(f"Change feed: next offset [bold]{cdc.feed.next_offset}[white], "
+            + f"oldest available [bold]{cdc.feed.oldest_offset}[white], capacity [bold]{cdc.feed.capacity}")
+
+def serve_change_feed(address: str):
+    """Description: Serves the change feed over TCP in the background.
+            Consumers send `<offset>` or `latest` in the first line and receive events as JSON lines.
+            Example: `serve_change_feed 127.0.0.1:8766`
+        Args:
+            *address (text): `host:port` or `:port` (host 127.0.0.1) to serve the feed at.
+    """
+    host, _, port = address.rpartition(":")
+    try:
+        cdc.serve_in_background((host or "127.0.0.1", int(port)))
+    except (ValueError, OSError):
+        rprint(f"[red]Can't serve the change feed at {address}! Try again.")
+        raise
+    rprint(f"Serving change feed at [bold]{host or '127.0.0.1'}:{port}")
+
+def memory_report():
+    """Description: Displays approximate memory taken by users, accounts and their histories.
+        Args: None
+    """
+    table = Table("Registry", "Records", "Size (MiB)")
+    total_bytes: int = 0
+    for name, (records, size) in memory_usage().items():
+        table.add_row(name, str(records), f"{size / 2**20:.2f}")
+        total_bytes += size
+    table.add_row("", "Total", f"{total_bytes / 2**20:.2f}", end_section=True)
+    console.print(table)
 
 def exit():
     """Exit program with code 0. Also possible to exit using 'Ctrl + C.'
@@ -38,3 +38,43 @@ class MissingArgumentError(Exception):
 class ExcessArgumentsError(Exception): 
     """Raises if excess arguments are passed in CLI."""
     ...
+
+class UnsupportedFormatError(Exception):
+    """Raises if file format is neither CSV nor JSON Lines."""
+    ...
+
+class BulkImportError(Exception):
+    """Raises if a chunk of imported records fails validation.
+    Chunks imported before the failing one are kept.
+    """
+    ...
+
+class SchedulerOverloadedError(Exception):
+    """Raises if a command is shed because the queue
+    of its priority class is full.
+    """
+    ...
+
+class IntegrityError(Exception):
+    """Raises if account's history, balance and digest don't agree
+    or if the book differs from the one it is verified against.
+    """
+    ...
+
+class FeedOverflowError(Exception):
+    """Raises if a change feed subscriber is so far behind that
+    the events it hasn't read yet were overwritten.
+    """
+    ...
+
+class FeedOffsetError(Exception):
+    """Raises if a change feed subscriber asks for an offset the feed
+    hasn't reached, e.g. one saved before a restart.
+    """
+    ...
+
+class OrderNotFoundError(Exception):
+    """Raises if operation on non-existent standing order
+    (e.g. `cancel_order`).
+    """
+    ...
@@ -0,0 +1,241 @@
+"""Integrity of the book: history hash chains and a bank-wide root.
+
+Every account keeps the digest of its history, chained operation by
+operation on append (see `user._chain_digest`). The bank-wide root is
+a Merkle tree over a fixed number of buckets, an account goes to the
+bucket given by its ID. A bucket's value is the sum of its accounts'
+leaf hashes, so postings, new and deleted accounts update one bucket
+in O(1) and only the path from it to the root is rehashed, lazily.
+
+Two books (e.g. the live one and a backup) are compared by their
+roots, and divergent buckets are found by descending only into
+the subtrees whose hashes differ: O(log n) steps per divergence.
+Every bucket also knows its accounts, so only the accounts of divergent
+buckets are compared, never the whole book.
+"""
+import hashlib
+import threading
+import zlib
+from typing import Iterable
+import bulk
+from exceptions import BulkImportError
+from user import (
+    Account, Operation, _Balance, _apply_operations, _chain_digest, _genesis_digest, subscribe,
+)
+
+
+BUCKETS: int = 4096
+MODULUS: int = 2 ** 128
+
+
+def bucket_of(account_id: str, buckets: int = BUCKETS) -> int:
+    # Stable between processes, unlike `hash`.
+    return zlib.crc32(account_id.encode()) % buckets
+
+
+def leaf(account_id: str, digest: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(account_id.encode() + b"\x00" + digest, digest_size=16).digest(), "big")
+
+
+class MerkleTree:
+    def __init__(self, buckets: int = BUCKETS) -> None:
+        self.buckets: int = buckets
+        self.sums: list[int] = [0] * buckets
+        # Account IDs of every bucket, so divergent buckets are
+        # resolved to accounts without scanning the book.
+        self.members: list[set[str]] = [set() for _ in range(buckets)]
+        # Heap layout: node `i` has children `2i` and `2i + 1`, the root
+        # is node 1, buckets are the last `buckets` nodes.
+        # None marks a node to be rehashed.
+        self._nodes: list[bytes | None] = [None] * (2 * buckets)
+        self._lock = threading.Lock()
+
+    def _invalidate(self, bucket: int) -> None:
+        node: int = self.buckets + bucket
+        # Ancestors of an invalidated node are invalidated already.
+        while node and self._nodes[node] is not None:
+            self._nodes[node] = None
+            node //= 2
+
+    def _update(self, account_id: str, delta: int, member: bool | None = None) -> None:
+        bucket: int = bucket_of(account_id, self.buckets)
+        with self._lock:
+            self.sums[bucket] = (self.sums[bucket] + delta) % MODULUS
+            self._invalidate(bucket)
+            if member:
+                self.members[bucket].add(account_id)
+            elif member is not None:
+                self.members[bucket].discard(account_id)
+
+    def add(self, account_id: str, digest: bytes) -> None:
+        self._update(account_id, leaf(account_id, digest), True)
+
+    def remove(self, account_id: str, digest: bytes) -> None:
+        self._update(account_id, -leaf(account_id, digest), False)
+
+    def replace(self, account_id: str, old_digest: bytes, new_digest: bytes) -> None:
+        self._update(account_id, leaf(account_id, new_digest) - leaf(account_id, old_digest))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.sums = [0] * self.buckets
+            self.members = [set() for _ in range(self.buckets)]
+            self._nodes = [None] * (2 * self.buckets)
+
+    def node(self, index: int) -> bytes:
+        """Hash of the node `index`, rehashed if needed."""
+        with self._lock:
+            return self._node(index)
+
+    def _node(self, index: int) -> bytes:
+        value: bytes | None = self._nodes[index]
+        if value is None:
+            if index >= self.buckets:
+                data: bytes = self.sums[index - self.buckets].to_bytes(16, "big")
+            else:
+                data = self._node(2 * index) + self._node(2 * index + 1)
+            value = hashlib.blake2b(data, digest_size=16).digest()
+            self._nodes[index] = value
+        return value
+
+    def root(self) -> bytes:
+        return self.node(1)
+
+    def diverging_buckets(self, other: "MerkleTree") -> list[int]:
+        """Buckets whose accounts differ between the two trees."""
+        if self.buckets != other.buckets:
+            raise ValueError("trees have different number of buckets")
+        buckets: list[int] = []
+        stack: list[int] = [1]
+        while stack:
+            index: int = stack.pop()
+            if self.node(index) == other.node(index):
+                continue
+            if index >= self.buckets:
+                buckets.append(index - self.buckets)
+            else:
+                stack.extend((2 * index + 1, 2 * index))
+        return sorted(buckets)
+
+
+# Tree of the live book, kept up to date by `user` notifications.
+tree = MerkleTree()
+
+
+def _on_change(event: str, record, previous) -> None:
+    if event == "account_created":
+        tree.add(record.id, record.digest)
+    elif event in ("posted", "history_replaced"):
+        tree.replace(record.id, previous[3], record.digest)
+    elif event == "account_deleted":
+        tree.remove(record.id, previous[3])
+    elif event == "book_cleared":
+        tree.clear()
+
+subscribe(_on_change)
+
+
+def rebuild() -> None:
+    """Rebuilds the live tree from all accounts, e.g. if the registries
+    were changed without `user` notifications.
+    """
+    tree.clear()
+    for account in list(Account.accounts.values()):
+        tree.add(account.id, account.digest)
+
+
+def book_digests(records: Iterable[tuple[int, dict]],
+                    buckets: int = BUCKETS) -> tuple[MerkleTree, dict[str, bytes]]:
+    """Tree and account digests of a book file (see `bulk.read_records`),
+    computed without touching the live book.
+    Raises `BulkImportError` if the file is invalid.
+    """
+    # account ID -> (balance, digest)
+    states: dict[str, tuple[_Balance, bytes]] = {}
+    # Users and accounts are validated at the end, as a whole.
+    owners: list[tuple[int, bulk.Record]] = []
+    errors: list[tuple[int, str]] = []
+    for line_number, record in records:
+        if record.get("type") != "posting":
+            owners.append((line_number, record))
+            if record.get("type") == "account":
+                account_id: str = record.get("id") or ""
+                initial_balance: str = record.get("amount") or "0"
+                try:
+                    bulk._validate_amount(initial_balance, positive=False)
+                except (ValueError, TypeError):
+                    # Reported by `_validate_chunk`, the account still exists.
+                    initial_balance = "0"
+                states[account_id] = (_Balance(initial_balance), _genesis_digest(account_id, initial_balance))
+            continue
+        problems: list[str] = bulk._validate_posting(record)
+        if record.get("id") not in states:
+            problems.append(f"account '{record.get('id')}' does not exist")
+        if problems:
+            errors.extend((line_number, problem) for problem in problems)
+            continue
+        balance, digest = states[record["id"]]
+        operation = (record["time"], record["kind"], float(record["amount"]), record.get("description") or "")
+        balance, _, digest = _apply_operations(balance, (operation,), digest)
+        states[record["id"]] = (balance, digest)
+    # Checked against an empty book, which is what the file describes.
+    errors.extend(bulk._validate_chunk(owners, users={}, accounts={}))
+    if errors:
+        bulk.print_errors(sorted(errors))
+        raise BulkImportError
+    other = MerkleTree(buckets)
+    digests: dict[str, bytes] = {}
+    for account_id, (_, digest) in states.items():
+        other.add(account_id, digest)
+        digests[account_id] = digest
+    return other, digests
+
+
+def diverging_accounts(other: MerkleTree, other_digests: dict[str, bytes]) -> list[tuple[str, bytes | None, bytes | None]]:
+    """Compares the live book with another one.
+    Returns `(account ID, live digest, other digest)` of the accounts
+    that differ, a digest being None if there's no such account.
+    """
+    buckets: set[int] = set(tree.diverging_buckets(other))
+    if not buckets:
+        return []
+    live: dict[str, bytes] = {}
+    for bucket in buckets:
+        with tree._lock:
+            account_ids: list[str] = list(tree.members[bucket])
+        for account_id in account_ids:
+            account: Account | None = Account.accounts.get(account_id)
+            if account is not None:
+                live[account_id] = account.digest
+    theirs: dict[str, bytes] = {
+        account_id: other_digests[account_id]
+        for bucket in buckets
+        for account_id in other.members[bucket]
+    }
+    return sorted(
+        (account_id, live.get(account_id), theirs.get(account_id))
+        for account_id in live.keys() | theirs.keys()
+        if live.get(account_id) != theirs.get(account_id)
+    )
+
+
+def check_account(account: Account) -> list[str]:
+    """Recomputes balance and digest of the account from its history.
+    Returns found problems, empty if history, balance and digest agree.
+    """
+    snapshot = account.snapshot()
+    balance: _Balance = _Balance(account._initial_balance)
+    digest: bytes = _genesis_digest(account.id, account._initial_balance)
+    problems: list[str] = []
+    operation: Operation
+    for number, operation in enumerate(snapshot.history, start=1):
+        time, kind, amount, description, balance_after = operation
+        balance = balance + amount if kind == "d" else balance - amount
+        if str(balance) != balance_after:
+            problems.append(f"operation {number}: balance {balance_after} should be {balance}")
+        digest = _chain_digest(digest, operation)
+    if str(balance) != str(snapshot.balance):
+        problems.append(f"balance {snapshot.balance} should be {balance}")
+    if digest != snapshot.digest:
+        problems.append("history digest doesn't match the history")
+    return problems
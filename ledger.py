@@ -0,0 +1,146 @@
+"""General ledger: bank-wide and per-day totals kept incrementally.
+
+Totals are updated by `user` notifications on every change of the book,
+in O(1) per account or operation, so reading them never touches
+the accounts. All amounts are in integer cents:
+    *deposits, withdrawals: everything ever posted.
+    *outstanding: sum of the balances of all accounts.
+    *overdrawn: number of accounts with a negative balance.
+    *accounts: number of accounts.
+Per day (YYYY-MM-DD), deposits and withdrawals are counted on the day
+of the operation, while outstanding and overdrawn are the values at the
+last change made on that day (by the clock, not by operation time),
+today's being the current ones; they are None for past days the ledger
+didn't run through, e.g. the days of imported or replayed operations.
+"""
+import threading
+from datetime import date
+from user import Account, Operation, _Balance, subscribe
+
+
+def to_cents(balance: _Balance) -> int:
+    return round(balance.value * 100)
+
+
+class Ledger:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.deposits: int = 0
+            self.withdrawals: int = 0
+            self.outstanding: int = 0
+            self.overdrawn: int = 0
+            self.accounts: int = 0
+            # day -> [deposits, withdrawals, outstanding, overdrawn]
+            self.days: dict[str, list[int | None]] = {}
+
+    def _day(self, day: str) -> list[int | None]:
+        totals: list[int | None] | None = self.days.get(day)
+        if totals is None:
+            totals = self.days[day] = [0, 0, None, None]
+        return totals
+
+    def _close_day(self) -> None:
+        # Called with the lock held, after every change.
+        totals: list[int | None] = self._day(date.today().isoformat())
+        totals[2] = self.outstanding
+        totals[3] = self.overdrawn
+
+    def _flows(self, operations, sign: int) -> None:
+        for time, kind, amount, _, _ in operations:
+            cents: int = sign * round(amount * 100)
+            totals: list[int | None] = self._day(time[:10])
+            if kind == "d":
+                self.deposits += cents
+                totals[0] += cents
+            else:
+                self.withdrawals += cents
+                totals[1] += cents
+
+    def _rebalance(self, old: int, new: int) -> None:
+        self.outstanding += new - old
+        self.overdrawn += (new < 0) - (old < 0)
+
+    def open_account(self, balance: int) -> None:
+        with self._lock:
+            self.accounts += 1
+            self._rebalance(0, balance)
+            self._close_day()
+
+    def close_account(self, balance: int) -> None:
+        with self._lock:
+            self.accounts -= 1
+            self._rebalance(balance, 0)
+            self._close_day()
+
+    def post(self, operations: list[Operation], old: int, new: int) -> None:
+        with self._lock:
+            self._flows(operations, 1)
+            self._rebalance(old, new)
+            self._close_day()
+
+    def replace(self, old_operations: list[Operation], operations: list[Operation],
+                old: int, new: int) -> None:
+        with self._lock:
+            self._flows(old_operations, -1)
+            self._flows(operations, 1)
+            self._rebalance(old, new)
+            self._close_day()
+
+    def summary(self, day: str | None = None) -> dict[str, int | None]:
+        """Bank-wide totals, or totals of `day` (zero flows if nothing
+        happened; current closing values for today, none for past days
+        the ledger didn't close).
+        """
+        with self._lock:
+            if day is None:
+                return {
+                    "deposits": self.deposits, "withdrawals": self.withdrawals,
+                    "outstanding": self.outstanding, "overdrawn": self.overdrawn, "accounts": self.accounts,
+                }
+            deposits, withdrawals, outstanding, overdrawn = self.days.get(day, (0, 0, None, None))
+            if day == date.today().isoformat():
+                # Today isn't over, its closing values are the current ones.
+                outstanding, overdrawn = self.outstanding, self.overdrawn
+            return {
+                "deposits": deposits, "withdrawals": withdrawals,
+                "outstanding": outstanding, "overdrawn": overdrawn,
+            }
+
+
+# Ledger of the live book, kept up to date by `user` notifications.
+ledger = Ledger()
+
+
+def _on_change(event: str, record, previous) -> None:
+    if event in ("posted", "history_replaced") and Account.accounts.get(record.id) is not record:
+        # Not in the book, its balance is not the bank's.
+        return
+    if event == "account_created":
+        ledger.open_account(to_cents(record.balance))
+    elif event == "account_deleted":
+        ledger.close_account(to_cents(previous[0]))
+    elif event == "posted":
+        # Still under the account's write lock, `history` is consistent.
+        ledger.post(record.history[previous[1]:], to_cents(previous[0]), to_cents(record.balance))
+    elif event == "history_replaced":
+        ledger.replace(previous[2][:previous[1]], record.history,
+                        to_cents(previous[0]), to_cents(record.balance))
+    elif event == "book_cleared":
+        ledger.clear()
+
+subscribe(_on_change)
+
+
+def rebuild() -> None:
+    """Rebuilds the ledger from all accounts, e.g. if the registries
+    were changed without `user` notifications.
+    """
+    ledger.clear()
+    for account in list(Account.accounts.values()):
+        snapshot = account.snapshot()
+        ledger.open_account(round(float(account._initial_balance) * 100))
+        ledger.post(list(snapshot.history), round(float(account._initial_balance) * 100), to_cents(snapshot.balance))
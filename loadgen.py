@@ -0,0 +1,275 @@
+"""Synthetic load generator and traffic replayer.
+
+Generates command streams the same as typed in the REPL: postings and
+statements of accounts picked with Zipfian skew (a few hot accounts,
+a long tail of cold ones), some with quoted descriptions, some with
+invalid amounts (`NegativeAmountError`, `WrongAmountFormat`).
+
+Streams are either written to a file (runnable with `main.py <file>`)
+or driven against a target:
+    *batch: commands are executed in this process through `main.parse`.
+    *HOST:PORT: a server started with `main.py --serve`.
+In closed-loop mode every client sends its next command once the
+previous one completes. In open-loop mode commands are sent at a fixed
+rate no matter how fast they complete, and latency is measured from
+the moment a command was due, so a slow target can't hide its queueing.
+
+Examples:
+    python loadgen.py emit --count 100000 --out traffic.txt
+    python loadgen.py run --target batch --mode closed --concurrency 4 --duration 10
+    python loadgen.py run --target 127.0.0.1:8765 --mode open --rate 2000 --duration 30
+    python loadgen.py replay traffic.txt --target 127.0.0.1:8765 --mode open --rate 500
+"""
+import argparse
+import bisect
+import collections
+import contextlib
+import itertools
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+from rich.console import Console
+from rich.table import Table
+from scheduler import percentile
+
+
+DEFAULT_MIX: str = "deposit=60,withdraw=30,show_bank_statement=10"
+DESCRIPTIONS: tuple[str, ...] = (
+    "Salary", "Rent for the flat", "Groceries", "Coffee", "Transfer to savings", "Refund for order 42",
+)
+
+
+class Workload:
+    """Endless stream of random commands over `accounts` accounts."""
+    def __init__(self, accounts: int = 1000, mix: str = DEFAULT_MIX, zipf: float = 1.1,
+                    invalid: float = 0.02, quoted: float = 0.3, seed: int | None = None) -> None:
+        self.accounts: int = accounts
+        self.invalid: float = invalid
+        self.quoted: float = quoted
+        self.random = random.Random(seed)
+        self.commands: list[str] = []
+        self.command_weights: list[float] = []
+        for part in mix.split(","):
+            command, _, weight = part.partition("=")
+            self.commands.append(command.strip())
+            self.command_weights.append(float(weight or 1))
+        # Rank `r` is picked with probability proportional to `1 / r ** zipf`.
+        self._cumulative: list[float] = list(itertools.accumulate(
+            1 / rank ** zipf for rank in range(1, accounts + 1)
+        ))
+
+    def setup(self) -> Iterator[str]:
+        """Commands creating the clients and their accounts."""
+        for rank in range(1, self.accounts + 1):
+            yield f"create_user c{rank}"
+            yield f"create_account a{rank} c{rank} 1000"
+
+    def client(self) -> str:
+        point: float = self.random.random() * self._cumulative[-1]
+        return f"c{bisect.bisect(self._cumulative, point) + 1}"
+
+    def amount(self) -> str:
+        if self.random.random() < self.invalid:
+            return self.random.choice(("-10", "0", "10.001", "-0.5"))
+        return f"{self.random.randint(1, 50000) / 100:.2f}"
+
+    def command(self) -> str:
+        command: str = self.random.choices(self.commands, self.command_weights)[0]
+        if command in ("deposit", "withdraw"):
+            line: str = f"{command} {self.client()} {self.amount()}"
+            if self.random.random() < self.quoted:
+                line += f' "{self.random.choice(DESCRIPTIONS)}"'
+            return line
+        elif command == "show_bank_statement":
+            return f"{command} {self.client()}"
+        return command
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            yield self.command()
+
+
+class _Results:
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.errors: collections.Counter = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, error: str | None) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+
+
+# Targets: a target is a factory making one connection per client,
+# a connection being a callable that executes a command and returns
+# an error name or None.
+
+def batch_target() -> Callable[[], Callable[[str], str | None]]:
+    import main
+
+    def execute(user_input: str) -> str | None:
+        try:
+            main.parse(user_input)
+        except Exception as error:
+            return type(error).__name__
+        return None
+
+    return lambda: execute
+
+
+def server_target(address: str) -> Callable[[], Callable[[str], str | None]]:
+    host, _, port = address.rpartition(":")
+
+    def connect() -> Callable[[str], str | None]:
+        connection = socket.create_connection((host or "127.0.0.1", int(port)))
+        file = connection.makefile("rwb")
+
+        def execute(user_input: str) -> str | None:
+            file.write(user_input.encode("utf-8") + b"\n")
+            file.flush()
+            response: str = file.readline().decode("utf-8").strip()
+            if not response:
+                raise ConnectionError("server closed the connection")
+            return None if response == "ok" else response.split(maxsplit=1)[-1]
+
+        return execute
+
+    return connect
+
+
+def run_closed(connect: Callable, commands: Iterator[str], concurrency: int,
+                duration: float) -> _Results:
+    """Every client sends the next command after the previous one is done."""
+    results = _Results()
+    commands_lock = threading.Lock()
+    deadline: float = time.perf_counter() + duration
+
+    def client() -> None:
+        execute = connect()
+        while time.perf_counter() < deadline:
+            with commands_lock:
+                user_input: str | None = next(commands, None)
+            if user_input is None:
+                return
+            started: float = time.perf_counter()
+            error: str | None = execute(user_input)
+            results.record(time.perf_counter() - started, error)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_open(connect: Callable, commands: Iterator[str], concurrency: int,
+                duration: float, rate: float) -> _Results:
+    """Commands are due at `rate` per second, executed by up to
+    `concurrency` clients. Latency counts from the moment a command was due.
+    """
+    results = _Results()
+    local = threading.local()
+
+    def send(user_input: str, due: float) -> None:
+        if not hasattr(local, "execute"):
+            local.execute = connect()
+        error: str | None = local.execute(user_input)
+        results.record(time.perf_counter() - due, error)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        started: float = time.perf_counter()
+        for number, user_input in enumerate(commands):
+            due: float = started + number / rate
+            if due - started >= duration:
+                break
+            delay: float = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, user_input, due)
+    return results
+
+
+def report(results: _Results, elapsed: float, console: Console) -> None:
+    latencies: list[float] = results.latencies
+    table = Table("Commands", "Errors", "Throughput (cmd/s)", "p50 (ms)", "p90 (ms)", "p99 (ms)", "max (ms)")
+    table.add_row(
+        str(len(latencies)),
+        str(sum(results.errors.values())),
+        f"{len(latencies) / elapsed:.1f}",
+        *(f"{percentile(latencies, fraction) * 1000:.3f}" for fraction in (0.50, 0.90, 0.99)),
+        f"{max(latencies, default=0) * 1000:.3f}",
+    )
+    console.print(table)
+    if results.errors:
+        errors = Table("Error", "Count")
+        for error, count in results.errors.most_common():
+            errors.add_row(error, str(count))
+        console.print(errors)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Synthetic load generator and traffic replayer.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    emit = subparsers.add_parser("emit", help="write a command stream to a file")
+    run = subparsers.add_parser("run", help="drive generated traffic against a target")
+    replay = subparsers.add_parser("replay", help="drive commands from a file against a target")
+    replay.add_argument("path")
+    emit.add_argument("--out", required=True)
+    emit.add_argument("--count", type=int, default=10000)
+    for subparser in (emit, run):
+        subparser.add_argument("--accounts", type=int, default=1000)
+        subparser.add_argument("--mix", default=DEFAULT_MIX, help=f"[default={DEFAULT_MIX}]")
+        subparser.add_argument("--zipf", type=float, default=1.1, help="skew of accounts, 0 is uniform")
+        subparser.add_argument("--invalid", type=float, default=0.02, help="share of invalid amounts")
+        subparser.add_argument("--seed", type=int)
+    for subparser in (run, replay):
+        subparser.add_argument("--target", default="batch", help="`batch` or HOST:PORT")
+        subparser.add_argument("--mode", choices=("closed", "open"), default="closed")
+        subparser.add_argument("--concurrency", type=int, default=4)
+        subparser.add_argument("--rate", type=float, default=1000, help="commands per second (open loop)")
+        subparser.add_argument("--duration", type=float, default=10, help="seconds")
+    run.add_argument("--no-setup", action="store_true", help="accounts already exist on the target")
+    args = parser.parse_args(argv)
+    console = Console()
+
+    if args.action == "emit":
+        workload = Workload(args.accounts, args.mix, args.zipf, args.invalid, seed=args.seed)
+        with open(args.out, "w", encoding="utf-8") as file:
+            for user_input in itertools.chain(workload.setup(), itertools.islice(workload, args.count)):
+                file.write(user_input + "\n")
+        console.print(f"Written {args.accounts * 2 + args.count} commands to [bold]{args.out}")
+        return
+
+    connect = batch_target() if args.target == "batch" else server_target(args.target)
+    # Commands executed in this process print a lot, which is not what is measured.
+    quiet = (contextlib.redirect_stdout(open(os.devnull, "w"))
+                if args.target == "batch" else contextlib.nullcontext())
+    with quiet, contextlib.ExitStack() as files:
+        if args.action == "run":
+            workload = Workload(args.accounts, args.mix, args.zipf, args.invalid, seed=args.seed)
+            if not args.no_setup:
+                execute = connect()
+                for user_input in workload.setup():
+                    execute(user_input)
+            commands: Iterator[str] = iter(workload)
+        else:
+            file = files.enter_context(open(args.path, encoding="utf-8"))
+            commands = (line.strip() for line in file if line.strip())
+
+        started: float = time.perf_counter()
+        if args.mode == "closed":
+            results: _Results = run_closed(connect, commands, args.concurrency, args.duration)
+        else:
+            results = run_open(connect, commands, args.concurrency, args.duration, args.rate)
+        elapsed: float = time.perf_counter() - started
+    report(results, elapsed, console)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,23 @@
 import inspect
 import itertools
+import sys
 from rich import print as rprint
 from commands import (
     create_user, create_account,
     delete_user, delete_account,
     display_users, display_accounts,
     deposit, withdraw, show_bank_statement,
-    exit
+    import_book, export_book, replay_book,
+    create_order, cancel_order, display_orders, run_orders,
+    accrue_interest, generate_statements, verify_root, verify, verify_account, change_feed, serve_change_feed, profile, scheduler_stats, ledger_summary, memory_report, exit
 )
 from exceptions import (
     MissingArgumentError,
     ExcessArgumentsError,
 )
+from profiler import profiler, start_from_env
+from scheduler import scheduler, start_from_env as start_scheduler_from_env
+from orders import start_from_env as start_orders_from_env
 
 COMMANDS = {
     "create_user": create_user,
@@ -23,6 +29,24 @@ COMMANDS = {
     "deposit": deposit,
     "withdraw": withdraw,
     "show_bank_statement": show_bank_statement,
+    "import_book": import_book,
+    "export_book": export_book,
+    "replay_book": replay_book,
+    "create_order": create_order,
+    "cancel_order": cancel_order,
+    "display_orders": display_orders,
+    "run_orders": run_orders,
+    "accrue_interest": accrue_interest,
+    "generate_statements": generate_statements,
+    "verify_root": verify_root,
+    "verify": verify,
+    "verify_account": verify_account,
+    "change_feed": change_feed,
+    "serve_change_feed": serve_change_feed,
+    "profile": profile,
+    "scheduler_stats": scheduler_stats,
+    "ledger_summary": ledger_summary,
+    "memory_report": memory_report,
     "exit": exit,
 }
 
@@ -61,6 +85,18 @@ def display_command_help(command: str) -> None:
     rprint(f"\t'{function.__name__}'")
     rprint(f"\t[blue]{function.__doc__}")
 
+def dispatch(command, args: list) -> None:
+    """Executes a parsed command. All commands are executed here.
+
+    If the scheduler is running, the command is queued by its
+    priority class and this waits for it to complete.
+    """
+    name: str = command.__name__
+    if scheduler.running:
+        scheduler.submit(name, profiler.call, name, command, *args).result()
+    else:
+        profiler.call(name, command, *args)
+
 def parse(user_input: str) -> None:
     """Main CLI parser.
     
@@ -78,7 +114,7 @@ def parse(user_input: str) -> None:
     command = COMMANDS[user_input.split()[0]]
     command_params = inspect.signature(command).parameters.values()
     if len(user_input.split()) == 1 and len(command_params) == 0:
-        command()
+        dispatch(command, [])
     elif len(user_input.split()) == 1 and len(command_params) != 0:
         display_command_help(user_input)
     elif user_input.split()[1] in ["help", "-h", "--help"]:
@@ -104,19 +140,42 @@ def parse(user_input: str) -> None:
         if len(function_args) > len(command_params):
             rprint(f"Too many arguments! Expected: [blue]{len(command_params)}[white]. Got [red]{len(function_args)}.")
             raise ExcessArgumentsError
-        command(*function_args)        
+        dispatch(command, function_args)
+
+def execute(user_input: str) -> None:
+    """Executes one line of input as the REPL does."""
+    user_input = user_input.strip()
+    if not user_input:
+        ...
+    elif user_input.split()[0] in COMMANDS:
+        try:
+            parse(user_input)
+        except Exception:
+            return
+    else:
+        # Show all available commands on errors.
+        display_available_commands()
+
+def run_batch(path: str) -> None:
+    """Batch mode: executes commands from a file, one per line."""
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            execute(line)
 
 if __name__ == "__main__":
+    start_from_env()
+    start_scheduler_from_env()
+    start_orders_from_env()
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        from server import parse_address, serve
+        serve(parse_address(sys.argv[2] if len(sys.argv) > 2 else None))
+        sys.exit(0)
+    elif len(sys.argv) > 1:
+        run_batch(sys.argv[1])
+        sys.exit(0)
     while True:
-        raw_input: str = input("> ")
-        user_input: str = raw_input.strip()
-        if not user_input:
-            ...
-        elif user_input.split()[0] in COMMANDS:
-            try:
-                parse(user_input)
-            except Exception:
-                continue
-        else:
-            # Show all available commands on errors.
-            display_available_commands()
+        try:
+            raw_input: str = input("> ")
+        except EOFError:
+            break
+        execute(raw_input)
@@ -0,0 +1,185 @@
+"""Standing orders: scheduled and recurring postings of clients.
+
+Pending orders are kept in a heap of due times, every due time with
+the bucket of orders due then, so the orders that are due are found
+without looking at the others, and the millions due at the same
+moment (e.g. salaries on the 1st) are taken with one heap operation.
+The ledger clock (`OrderBook.start`, one tick per second by default)
+runs everything that became due since the previous tick in one batch:
+orders are grouped by account and every account gets one bulk
+posting, dated by the clock, without `check_validity` and without
+printing.
+
+An order that was due several times since it last ran (e.g. the clock
+was stopped) is posted once per missed period. Orders of clients
+that have no account anymore are dropped when they become due.
+"""
+import calendar
+import heapq
+import itertools
+import os
+import threading
+from datetime import datetime, timedelta
+from user import Account, User
+
+
+TIME_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+PERIODS: tuple[str, ...] = ("once", "daily", "weekly", "monthly")
+
+
+def next_due(due: datetime, period: str, day: int) -> datetime:
+    """Due time following `due`; monthly orders keep to `day` of month,
+    or to the last day of shorter months.
+    """
+    if period == "daily":
+        return due + timedelta(days=1)
+    elif period == "weekly":
+        return due + timedelta(weeks=1)
+    year, month = (due.year + 1, 1) if due.month == 12 else (due.year, due.month + 1)
+    return due.replace(year=year, month=month, day=min(day, calendar.monthrange(year, month)[1]))
+
+
+class StandingOrder:
+    __slots__ = ("id", "client_id", "kind", "amount", "description", "due", "period", "day", "cancelled")
+
+    def __init__(self, id: int, client_id: str, kind: str, amount: float, description: str,
+                    due: datetime, period: str = "once") -> None:
+        self.id: int = id
+        self.client_id: str = client_id
+        self.kind: str = kind
+        self.amount: float = amount
+        self.description: str = description
+        self.due: datetime = due
+        self.period: str = period
+        self.day: int = due.day
+        self.cancelled: bool = False
+
+    def __repr__(self) -> str:
+        return (f"StandingOrder: id={self.id}, client='{self.client_id}', kind='{self.kind}', "
+                + f"amount={self.amount}, due='{self.due:{TIME_FORMAT}}', period='{self.period}'")
+
+
+class OrderBook:
+    def __init__(self) -> None:
+        self._heap: list[str] = []
+        # due time -> orders due then, in the order they were scheduled.
+        self._buckets: dict[str, list[StandingOrder]] = {}
+        self.orders: dict[int, StandingOrder] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, client_id: str, kind: str, amount: float, due: datetime,
+            period: str = "once", description: str = "") -> StandingOrder:
+        if period not in PERIODS:
+            raise ValueError(f"unknown period '{period}'")
+        with self._lock:
+            order = StandingOrder(next(self._ids), client_id, kind, amount, description, due, period)
+            self.orders[order.id] = order
+            self._schedule(due.strftime(TIME_FORMAT), [order])
+        return order
+
+    def _schedule(self, due: str, orders: list[StandingOrder]) -> None:
+        bucket: list[StandingOrder] | None = self._buckets.get(due)
+        if bucket is None:
+            self._buckets[due] = orders
+            heapq.heappush(self._heap, due)
+        else:
+            bucket.extend(orders)
+
+    def cancel(self, order_id: int) -> StandingOrder | None:
+        """Cancels the order; it stays in its bucket until it is due."""
+        with self._lock:
+            order: StandingOrder | None = self.orders.pop(order_id, None)
+            if order is not None:
+                order.cancelled = True
+        return order
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap.clear()
+            self._buckets.clear()
+            self.orders.clear()
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def run(self, now: datetime | None = None) -> tuple[int, int]:
+        """Posts all orders due by `now` (by the clock by default).
+        Returns the numbers of postings and accounts.
+        """
+        now = now or datetime.now()
+        now_string: str = now.strftime(TIME_FORMAT)
+        batches: dict[Account, list[tuple[str, str, float, str]]] = {}
+        # (due, period, day) -> next due time, orders of a bucket mostly share them.
+        following: dict[tuple[datetime, str, int], tuple[datetime, str]] = {}
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0] <= now_string:
+                rescheduled: dict[str, list[StandingOrder]] = {}
+                for order in self._buckets.pop(heapq.heappop(heap)):
+                    if order.cancelled:
+                        continue
+                    account: Account | None = getattr(User.users.get(order.client_id), "account", None)
+                    if account is None or Account.accounts.get(account.id) is not account:
+                        order.cancelled = True
+                        self.orders.pop(order.id, None)
+                        continue
+                    operations = batches.setdefault(account, [])
+                    operation: tuple[str, str, float, str] = (now_string, order.kind, order.amount, order.description)
+                    operations.append(operation)
+                    if order.period == "once":
+                        self.orders.pop(order.id, None)
+                        continue
+                    key: tuple[datetime, str, int] = (order.due, order.period, order.day)
+                    if key not in following:
+                        due: datetime = next_due(order.due, order.period, order.day)
+                        following[key] = (due, due.strftime(TIME_FORMAT))
+                    order.due, due_string = following[key]
+                    while order.due <= now:
+                        operations.append(operation)
+                        order.due = next_due(order.due, order.period, order.day)
+                        due_string = order.due.strftime(TIME_FORMAT)
+                    rescheduled.setdefault(due_string, []).append(order)
+                for due_string, orders in rescheduled.items():
+                    self._schedule(due_string, orders)
+        # Posted without the lock, orders may be added meanwhile.
+        for account, operations in batches.items():
+            account._post_many(operations)
+        return sum(map(len, batches.values())), len(batches)
+
+    def start(self, tick: float = 1.0) -> None:
+        """Starts the ledger clock running due orders every `tick` seconds."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._clock, args=(tick,), name="standing-orders", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _clock(self, tick: float) -> None:
+        while not self._stop.wait(tick):
+            self.run()
+
+
+order_book = OrderBook()
+
+
+def start_from_env() -> None:
+    """Starts the ledger clock, ticking every `BANK_ORDERS_TICK` seconds
+    (1 by default, 0 doesn't start it).
+    """
+    tick: float = float(os.environ.get("BANK_ORDERS_TICK", "1"))
+    if tick > 0:
+        order_book.start(tick)
@@ -0,0 +1,203 @@
+"""In-process profiling of executed commands.
+
+Every command goes through `Profiler.call` (see `main.dispatch`).
+When profiling is off it is a plain function call. Otherwise,
+depending on the mode:
+    *sample: a background thread samples stacks of the threads running
+        commands. Dumped as collapsed stacks (`<prefix>.folded`), one
+        `command;frame;frame count` line per stack, ready for
+        `flamegraph.pl` or speedscope.
+    *trace: every command runs under `cProfile`. Dumped as
+        `<prefix>.prof`, readable by `pstats`/snakeviz.
+    *alloc, alone or combined with one of them (e.g. `sample+alloc`):
+        `tracemalloc` diffs before and after every command. Dumped as
+        `<prefix>.alloc.txt`, top allocating lines per command.
+
+Profiling can be turned on at start with the `BANK_PROFILE` environment
+variable (e.g. `BANK_PROFILE=sample+alloc`), it is dumped to
+`BANK_PROFILE_OUT` (default "profile") on exit.
+"""
+import atexit
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable
+
+
+MODES: tuple[str, ...] = ("sample", "trace")
+SAMPLE_INTERVAL: float = 0.005
+TOP_ALLOCATIONS: int = 10
+# Profiler's own allocations are not interesting.
+ALLOCATION_FILTERS: tuple[tracemalloc.Filter, ...] = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.mode: str | None = None
+        self.track_allocations: bool = False
+        self.interval: float = SAMPLE_INTERVAL
+        # command name -> [calls, total seconds]
+        self.timings: dict[str, list] = {}
+        self.samples: Counter = Counter()
+        self.allocations: dict[str, Counter] = {}
+        self.stats: pstats.Stats | None = None
+        # thread id -> command it is running, read by the sampler.
+        self._running: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._sampler: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return self.mode is not None or self.track_allocations
+
+    def start(self, mode: str = "sample") -> None:
+        """Starts profiling. `mode` is "sample", "trace", either of them
+        combined with "alloc" (e.g. "alloc+sample"), or just "alloc".
+        """
+        parts: set[str] = set(mode.split("+"))
+        if not parts <= {*MODES, "alloc"}:
+            raise ValueError(f"unknown profiling mode '{mode}'")
+        profile_modes: set[str] = parts & set(MODES)
+        if len(profile_modes) > 1:
+            raise ValueError(f"profiling mode '{mode}' combines {' and '.join(sorted(profile_modes))}, "
+                                + "only one of them can be on")
+        profile_mode: str | None = profile_modes.pop() if profile_modes else None
+        track_allocations: bool = "alloc" in parts
+        self.stop()
+        self.clear()
+        self.mode = profile_mode
+        self.track_allocations = track_allocations
+        if track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+        if profile_mode == "sample":
+            self._stopped.clear()
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        """Stops profiling, collected data is kept until `start` or `clear`."""
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+        if self.track_allocations:
+            tracemalloc.stop()
+        self.mode = None
+        self.track_allocations = False
+
+    def clear(self) -> None:
+        self.timings.clear()
+        self.samples.clear()
+        self.allocations.clear()
+        self.stats = None
+
+    def call(self, name: str, function: Callable, *args):
+        """Executes `function(*args)` as the command `name`."""
+        if not self.active:
+            return function(*args)
+
+        thread_id: int = threading.get_ident()
+        before: tracemalloc.Snapshot | None = None
+        profile: cProfile.Profile | None = None
+        if self.track_allocations:
+            before = tracemalloc.take_snapshot()
+        if self.mode == "trace":
+            profile = cProfile.Profile()
+        self._running[thread_id] = name
+        started: float = time.perf_counter()
+        try:
+            if profile is not None:
+                return profile.runcall(function, *args)
+            return function(*args)
+        finally:
+            elapsed: float = time.perf_counter() - started
+            self._running.pop(thread_id, None)
+            with self._lock:
+                timing: list = self.timings.setdefault(name, [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                if profile is not None:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+            if before is not None and tracemalloc.is_tracing():
+                self._record_allocations(name, before, tracemalloc.take_snapshot())
+
+    def _record_allocations(self, name: str, before: tracemalloc.Snapshot,
+                            after: tracemalloc.Snapshot) -> None:
+        differences = after.filter_traces(ALLOCATION_FILTERS).compare_to(
+            before.filter_traces(ALLOCATION_FILTERS), "lineno")
+        with self._lock:
+            allocations: Counter = self.allocations.setdefault(name, Counter())
+            for difference in differences[:TOP_ALLOCATIONS]:
+                if difference.size_diff > 0:
+                    allocations[str(difference.traceback[0])] += difference.size_diff
+
+    def _sample(self) -> None:
+        """Sampler thread: records stacks of running commands."""
+        stop_code = Profiler.call.__code__
+        while not self._stopped.wait(self.interval):
+            if not self._running:
+                continue
+            frames = sys._current_frames()
+            for thread_id, name in list(self._running.items()):
+                frame = frames.get(thread_id)
+                stack: list[str] = []
+                # Frames above `call` (REPL, parser) are the same for all commands.
+                while frame is not None and frame.f_code is not stop_code:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(name)
+                self.samples[";".join(reversed(stack))] += 1
+
+    def top_allocations(self, name: str, limit: int = TOP_ALLOCATIONS) -> list[tuple[str, int]]:
+        return self.allocations.get(name, Counter()).most_common(limit)
+
+    def dump(self, prefix: str = "profile") -> list[str]:
+        """Writes collected data to files starting with `prefix`.
+        Returns the paths of the written files.
+        """
+        written: list[str] = []
+        if self.samples:
+            path: str = f"{prefix}.folded"
+            with open(path, "w", encoding="utf-8") as file:
+                for stack, count in self.samples.items():
+                    file.write(f"{stack} {count}\n")
+            written.append(path)
+        if self.stats is not None:
+            path = f"{prefix}.prof"
+            self.stats.dump_stats(path)
+            written.append(path)
+        if self.allocations:
+            path = f"{prefix}.alloc.txt"
+            with open(path, "w", encoding="utf-8") as file:
+                for name in self.allocations:
+                    calls, total = self.timings.get(name, (0, 0.0))
+                    file.write(f"{name}: {calls} calls, {total:.3f}s\n")
+                    for line, size in self.top_allocations(name):
+                        file.write(f"\t{size / 1024:10.1f} KiB  {line}\n")
+            written.append(path)
+        return written
+
+
+profiler = Profiler()
+
+
+def start_from_env() -> None:
+    """Starts profiling if `BANK_PROFILE` is set and dumps it on exit."""
+    mode: str | None = os.environ.get("BANK_PROFILE")
+    if not mode:
+        return
+    profiler.start(mode)
+    atexit.register(lambda: profiler.dump(os.environ.get("BANK_PROFILE_OUT", "profile")))
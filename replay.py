@@ -0,0 +1,257 @@
+"""Parallel replay of a book file (see `bulk`) into an empty book.
+
+Replay is a map and a reduce, both spread over worker processes:
+    *map: the file is split into byte ranges at record boundaries and
+        every range is read by its own worker. It validates its postings
+        and spools them to a temporary directory, one file per partition
+        of accounts, keeping their order.
+    *reduce: every partition is replayed by a worker, which concatenates
+        the spooled postings in file order and applies them with
+        `user._apply_operations`, skipping printing.
+So neither reading nor replaying is bound to one core. This process
+only deals with users and accounts, which are few compared to postings,
+and merges the replayed histories into `Account.accounts`.
+
+The current book is replaced only once the whole file was read and
+validated: an invalid file leaves it as it was.
+"""
+import contextlib
+import csv
+import os
+import pickle
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Iterator
+import bulk
+from exceptions import BulkImportError
+from user import Account, User, Operation, _Balance, _apply_operations, _genesis_digest, clear_book
+
+
+# Byte ranges and account partitions per worker: a few per worker
+# even out ranges and accounts of different weight.
+SHARDS_PER_WORKER: int = 4
+BLOCK_SIZE: int = 1 << 20
+
+# `(line number, record)` pairs of users and accounts, validation errors,
+# line of the first posting of every account and number of lines read.
+ShardResult = tuple[list[tuple[int, bulk.Record]], list[tuple[int, str]], dict[str, int], int]
+
+
+def normalize_as_of(as_of: str) -> str:
+    """Turns `YYYY-MM-DD` or `YYYY-MM-DD[T ]HH:MinMin:SS` into the
+    history time format. A bare date means the end of that day.
+    """
+    moment: datetime = datetime.fromisoformat(as_of.replace("/", "-"))
+    if len(as_of) == 10:
+        moment = moment.replace(hour=23, minute=59, second=59)
+    return moment.strftime(bulk.TIME_FORMAT)
+
+
+def partition_of(account_id: str, partitions: int) -> int:
+    # Stable between processes, unlike `hash`.
+    return zlib.crc32(account_id.encode()) % partitions
+
+
+def boundaries(path: str, file_format: str, shards: int) -> list[int]:
+    """Offsets splitting the file into at most `shards` byte ranges,
+    every one starting at a record (the first one after the CSV header).
+    """
+    size: int = os.path.getsize(path)
+    with open(path, "rb") as file:
+        start: int = len(file.readline()) if file_format == "csv" else 0
+        offsets: list[int] = [start]
+        position: int = start
+        # Quotes before `position`: a newline ends a CSV record only
+        # if their number is even, otherwise it's inside a quoted field.
+        quotes: int = 0
+        for shard in range(1, shards):
+            target: int = start + (size - start) * shard // shards
+            if offsets[-1] >= target:
+                continue
+            if file_format == "csv":
+                while position < target:
+                    block: bytes = file.read(min(BLOCK_SIZE, target - position))
+                    quotes += block.count(b'"')
+                    position += len(block)
+                while True:
+                    line: bytes = file.readline()
+                    quotes += line.count(b'"')
+                    position += len(line)
+                    if not line or quotes % 2 == 0:
+                        break
+            else:
+                # JSON escapes newlines in strings, every line is a record.
+                file.seek(target - 1)
+                position = target - 1 + len(file.readline())
+            if offsets[-1] < position < size:
+                offsets.append(position)
+    offsets.append(size)
+    return offsets
+
+
+def _read_range(path: str, file_format: str, fieldnames: list[str] | None, start: int, end: int,
+                counter: list[int], errors: list[tuple[int, str]]) -> Iterator[tuple[int, bulk.Record]]:
+    """`(line number in the range, record)` pairs of the records starting
+    in `[start, end)`; `counter[0]` is the number of lines read.
+    Lines that are not JSON objects go to `errors`.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+
+        def lines() -> Iterator[str]:
+            position: int = start
+            for line in file:
+                if position >= end:
+                    return
+                position += len(line)
+                counter[0] += 1
+                yield line.decode("utf-8")
+
+        if file_format == "csv":
+            reader = csv.DictReader(lines(), fieldnames)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(lines(), start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record: bulk.Record = bulk.decode_line(line)
+                except ValueError as error:
+                    errors.append((line_number, str(error)))
+                    continue
+                yield line_number, record
+
+
+def _read_shard(task: tuple) -> ShardResult:
+    """Worker (map): reads one byte range and spools its postings."""
+    path, file_format, fieldnames, start, end, shard, partitions, as_of, spool = task
+    owners: list[tuple[int, bulk.Record]] = []
+    errors: list[tuple[int, str]] = []
+    first_postings: dict[str, int] = {}
+    parts: list[dict[str, list[tuple[str, str, float, str]]]] = [{} for _ in range(partitions)]
+    # account ID -> its postings in this range.
+    account_postings: dict[str, list[tuple[str, str, float, str]]] = {}
+    counter: list[int] = [0]
+    for line_number, record in _read_range(path, file_format, fieldnames, start, end, counter, errors):
+        if record.get("type") != "posting":
+            owners.append((line_number, record))
+            continue
+        problems: list[str] = bulk._validate_posting(record)
+        if problems:
+            errors.extend((line_number, problem) for problem in problems)
+            continue
+        account_id: str = record.get("id") or ""
+        time: str = record["time"]
+        postings: list[tuple[str, str, float, str]] | None = account_postings.get(account_id)
+        if postings is None:
+            first_postings[account_id] = line_number
+            postings = account_postings[account_id] = []
+            parts[partition_of(account_id, partitions)][account_id] = postings
+        # Time format sorts lexicographically, no need to parse it.
+        if as_of is None or time <= as_of:
+            postings.append((time, record["kind"], float(record["amount"]), record.get("description") or ""))
+    for number, part in enumerate(parts):
+        with open(os.path.join(spool, f"{shard}-{number}"), "wb") as file:
+            pickle.dump(part, file, pickle.HIGHEST_PROTOCOL)
+    return owners, errors, first_postings, counter[0]
+
+
+def _replay_partition(task: tuple) -> dict[str, tuple[_Balance, list[Operation], bytes]]:
+    """Worker (reduce): replays the spooled postings of one partition.
+    Postings of every account are kept in their file order.
+    """
+    spool, shards, number, initial_balances = task
+    operations: dict[str, list[tuple[str, str, float, str]]] = {}
+    for shard in range(shards):
+        with open(os.path.join(spool, f"{shard}-{number}"), "rb") as file:
+            part: dict[str, list[tuple[str, str, float, str]]] = pickle.load(file)
+        for account_id, account_operations in part.items():
+            if account_id in operations:
+                operations[account_id].extend(account_operations)
+            else:
+                operations[account_id] = account_operations
+    return {
+        account_id: _apply_operations(
+            _Balance(initial_balances[account_id]),
+            account_operations,
+            _genesis_digest(account_id, initial_balances[account_id]),
+        )
+        for account_id, account_operations in operations.items()
+    }
+
+
+def replay(path: str, workers: int | None = None, as_of: str | None = None) -> tuple[int, int, int]:
+    """Rebuilds the book from a book file, replacing the current one.
+
+    `workers` defaults to the number of cores, `workers=1` replays in
+    this process. `as_of` (in the history time format, see
+    `normalize_as_of`) reconstructs the state at that moment.
+    Raises `BulkImportError` (and keeps the current book) if the file
+    is invalid. Returns the number of replayed users, accounts and postings.
+    """
+    workers = workers or os.cpu_count() or 1
+    file_format: str = bulk.detect_format(path)
+    fieldnames: list[str] | None = None
+    if file_format == "csv":
+        with open(path, newline="", encoding="utf-8") as file:
+            fieldnames = next(csv.reader(file), [])
+    offsets: list[int] = boundaries(path, file_format, workers * SHARDS_PER_WORKER)
+    partitions: int = workers * SHARDS_PER_WORKER
+
+    pool = ProcessPoolExecutor(workers) if workers > 1 else contextlib.nullcontext()
+    with tempfile.TemporaryDirectory() as spool, pool:
+        run = map if workers == 1 else pool.map
+        shards: int = len(offsets) - 1
+        tasks: list[tuple] = [
+            (path, file_format, fieldnames, offsets[shard], offsets[shard + 1], shard, partitions, as_of, spool)
+            for shard in range(shards)
+        ]
+        owners: list[tuple[int, bulk.Record]] = []
+        errors: list[tuple[int, str]] = []
+        first_postings: dict[str, int] = {}
+        # Shards come in file order, line numbers are made global.
+        lines: int = 1 if file_format == "csv" else 0
+        for shard_owners, shard_errors, shard_postings, shard_lines in run(_read_shard, tasks):
+            owners.extend((lines + line_number, record) for line_number, record in shard_owners)
+            errors.extend((lines + line_number, error) for line_number, error in shard_errors)
+            for account_id, line_number in shard_postings.items():
+                first_postings.setdefault(account_id, lines + line_number)
+            lines += shard_lines
+
+        # Checked against an empty book, which is what it's replayed into.
+        errors.extend(bulk._validate_chunk(owners, users={}, accounts={}))
+        initial_balances: list[dict[str, str]] = [{} for _ in range(partitions)]
+        for _, record in owners:
+            if record.get("type") == "account":
+                initial_balances[partition_of(record["id"], partitions)][record["id"]] = record.get("amount") or "0"
+        errors.extend(
+            (line_number, f"account '{account_id}' does not exist")
+            for account_id, line_number in first_postings.items()
+            if account_id not in initial_balances[partition_of(account_id, partitions)]
+        )
+        if errors:
+            bulk.print_errors(sorted(errors))
+            raise BulkImportError
+
+        results: list[dict[str, tuple[_Balance, list[Operation], bytes]]] = list(run(
+            _replay_partition,
+            [(spool, shards, number, initial_balances[number]) for number in range(partitions)],
+        ))
+
+    clear_book()
+    users: int = 0
+    for _, record in owners:
+        if record["type"] == "user":
+            User(record["id"])
+            users += 1
+        else:
+            Account(record["id"], float(record.get("amount") or 0), owner_id=record["owner_id"])
+    postings: int = 0
+    for result in results:
+        for account_id, (balance, history, digest) in result.items():
+            Account.accounts[account_id]._replace_history(history, balance, digest)
+            postings += len(history)
+    return users, len(Account.accounts), postings
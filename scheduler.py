@@ -0,0 +1,174 @@
+"""Priority-aware command scheduler with admission control.
+
+Commands are split into priority classes, from the most to the least
+urgent: postings, lookups, reports. Every class has its own bounded
+queue. A command whose queue is full is shed right away with
+`SchedulerOverloadedError`, instead of waiting behind the others.
+Worker threads always take the most urgent queued command, and
+reports may occupy only part of the workers, so postings never wait
+for a burst of statements to finish.
+"""
+import collections
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+from rich import print as rprint
+from exceptions import SchedulerOverloadedError
+
+
+CLASSES: tuple[str, ...] = ("postings", "lookups", "reports")
+COMMAND_CLASSES: dict[str, str] = {
+    "deposit": "postings",
+    "withdraw": "postings",
+    "show_bank_statement": "reports",
+    "display_users": "reports",
+    "display_accounts": "reports",
+    "import_book": "reports",
+    "export_book": "reports",
+    "replay_book": "reports",
+    "memory_report": "reports",
+    "display_orders": "reports",
+    "run_orders": "reports",
+    "accrue_interest": "reports",
+    "generate_statements": "reports",
+    "verify": "reports",
+}
+DEFAULT_CLASS: str = "lookups"
+QUEUE_LIMITS: dict[str, int] = {"postings": 10000, "lookups": 1000, "reports": 100}
+# Latencies kept per class for percentiles.
+LATENCY_WINDOW: int = 10000
+
+
+class _ClassStats:
+    __slots__ = ("submitted", "completed", "shed", "running", "latencies")
+
+    def __init__(self) -> None:
+        self.submitted: int = 0
+        self.completed: int = 0
+        self.shed: int = 0
+        self.running: int = 0
+        # Seconds from submission to completion.
+        self.latencies: collections.deque = collections.deque(maxlen=LATENCY_WINDOW)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of `values`, 0 if empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self.workers: list[threading.Thread] = []
+        self.queue_limits: dict[str, int] = dict(QUEUE_LIMITS)
+        self.running_limits: dict[str, int] = {}
+        self.stats: dict[str, _ClassStats] = {name: _ClassStats() for name in CLASSES}
+        self._queues: dict[str, collections.deque] = {name: collections.deque() for name in CLASSES}
+        self._condition = threading.Condition()
+        self._stopping: bool = False
+
+    @property
+    def running(self) -> bool:
+        return bool(self.workers)
+
+    def start(self, workers: int = 4, report_workers: int | None = None) -> None:
+        """Starts worker threads. Reports may run on at most
+        `report_workers` of them. [default=half of the workers]
+        """
+        if self.running:
+            return
+        self._stopping = False
+        self.running_limits = {"reports": report_workers or max(1, workers // 2)}
+        for number in range(workers):
+            worker = threading.Thread(target=self._work, name=f"scheduler-{number}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        """Stops workers after queued commands are executed."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def submit(self, name: str, function: Callable, *args) -> Future:
+        """Queues `function(*args)` as the command `name`."""
+        command_class: str = COMMAND_CLASSES.get(name, DEFAULT_CLASS)
+        stats: _ClassStats = self.stats[command_class]
+        future: Future = Future()
+        with self._condition:
+            queue: collections.deque = self._queues[command_class]
+            if len(queue) >= self.queue_limits[command_class]:
+                stats.shed += 1
+                rprint(f"[red]Too many {command_class} queued! [white]`{name}` is rejected, try again later.")
+                raise SchedulerOverloadedError
+            stats.submitted += 1
+            queue.append((future, function, args, time.perf_counter()))
+            self._condition.notify()
+        return future
+
+    def _next(self) -> tuple[str, tuple] | None:
+        """Takes the most urgent command that may run now.
+        Must be called holding `_condition`.
+        """
+        for command_class in CLASSES:
+            queue: collections.deque = self._queues[command_class]
+            limit: int | None = self.running_limits.get(command_class)
+            if queue and (limit is None or self.stats[command_class].running < limit):
+                self.stats[command_class].running += 1
+                return command_class, queue.popleft()
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while (task := self._next()) is None:
+                    if self._stopping:
+                        return
+                    self._condition.wait()
+            command_class, (future, function, args, submitted) = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as error:
+                    future.set_exception(error)
+            with self._condition:
+                stats: _ClassStats = self.stats[command_class]
+                stats.running -= 1
+                stats.completed += 1
+                stats.latencies.append(time.perf_counter() - submitted)
+                # A report slot might have been freed for a waiting worker.
+                self._condition.notify()
+
+    def report(self) -> dict[str, dict[str, float]]:
+        """Per-class counters and latency percentiles (in seconds)."""
+        report: dict[str, dict[str, float]] = {}
+        with self._condition:
+            for command_class, stats in self.stats.items():
+                latencies: list[float] = list(stats.latencies)
+                report[command_class] = {
+                    "queued": len(self._queues[command_class]),
+                    "running": stats.running,
+                    "submitted": stats.submitted,
+                    "completed": stats.completed,
+                    "shed": stats.shed,
+                    "p50": percentile(latencies, 0.50),
+                    "p99": percentile(latencies, 0.99),
+                }
+        return report
+
+
+scheduler = Scheduler()
+
+
+def start_from_env() -> None:
+    """Starts the scheduler if `BANK_SCHEDULER_WORKERS` is set."""
+    workers: str | None = os.environ.get("BANK_SCHEDULER_WORKERS")
+    if workers:
+        scheduler.start(int(workers))
@@ -0,0 +1,60 @@
+"""Line-oriented TCP server in front of the scheduler.
+
+Every line a client sends is a command, the same as typed in the REPL.
+For every command the server answers `ok` or `error <ExceptionName>`,
+e.g. `error SchedulerOverloadedError` for shed commands
+or `error UnknownCommand`.
+Commands print their output on the server side. `exit` closes
+the connection, not the server.
+"""
+import socketserver
+from main import COMMANDS, parse
+from scheduler import scheduler
+
+
+DEFAULT_ADDRESS: tuple[str, int] = ("127.0.0.1", 8765)
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for raw_line in self.rfile:
+            user_input: str = raw_line.decode("utf-8").strip()
+            if not user_input:
+                continue
+            if user_input == "exit":
+                break
+            if user_input.split()[0] not in COMMANDS:
+                self.wfile.write(b"error UnknownCommand\n")
+                continue
+            try:
+                parse(user_input)
+            except Exception as error:
+                self.wfile.write(f"error {type(error).__name__}\n".encode("utf-8"))
+            else:
+                self.wfile.write(b"ok\n")
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_address(address: str | None) -> tuple[str, int]:
+    """Turns `host:port` (or just `port`) into an address tuple."""
+    if not address:
+        return DEFAULT_ADDRESS
+    host, _, port = address.rpartition(":")
+    return host or DEFAULT_ADDRESS[0], int(port)
+
+
+def serve(address: tuple[str, int] = DEFAULT_ADDRESS, workers: int = 4) -> None:
+    """Serves commands until interrupted. Commands are executed
+    by the scheduler, started here if it isn't already.
+    """
+    scheduler.start(workers)
+    with Server(address, _CommandHandler) as server:
+        print(f"Serving on {address[0]}:{address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
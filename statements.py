@@ -0,0 +1,208 @@
+"""Bulk statement generation for all accounts.
+
+Accounts are split into shards and every shard is processed by
+a worker process. Workers are forked, so they read the accounts they
+inherited from this process instead of receiving pickled histories;
+the book they see is the book at the moment the job was started.
+Where forking isn't available, statements are made in this process.
+
+Every statement is streamed to `<out_dir>/<account ID>.<format>` (the
+ID percent-encoded, so that different IDs never share a file) through
+a temporary file renamed when complete, so a job that was interrupted
+is resumed by running it again: accounts whose files exist are skipped.
+
+Unlike `show_bank_statement`, the opening balance of a statement is the
+balance at `since`, and operations are taken from `[since, till)`.
+"""
+import csv
+import json
+import multiprocessing
+import os
+import urllib.parse
+from typing import Iterator, TextIO
+from rich.progress import Progress
+from user import Account, Operation
+
+
+FORMATS: tuple[str, ...] = ("txt", "csv", "json")
+SHARD_SIZE: int = 1000
+
+
+def to_cents(amount) -> int:
+    return round(float(amount) * 100)
+
+
+def dollars(cents: int) -> str:
+    return f"{'-' if cents < 0 else ''}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def file_name(account_id: str, file_format: str) -> str:
+    quoted: str = urllib.parse.quote(account_id, safe="")
+    if quoted in (".", ".."):
+        # Left as is by `quote`, but never a file name of their own.
+        quoted = quoted.replace(".", "%2E")
+    return f"{quoted}.{file_format}"
+
+
+class Statement:
+    """Statement of one account for `[since, till)`, amounts in cents.
+    Operations are read lazily from the account's snapshot.
+    """
+    def __init__(self, account: Account, since: str, till: str) -> None:
+        self.account_id: str = account.id
+        self.owner_id: str = account.owner.id
+        self.since: str = since
+        self.till: str = till
+        self._history: Iterator[Operation] = iter(account.snapshot().history)
+        self.opening: int = to_cents(account._initial_balance)
+        self.deposits: int = 0
+        self.withdrawals: int = 0
+        self._first: Operation | None = None
+        for operation in self._history:
+            if operation[0] >= since:
+                self._first = operation
+                break
+            self.opening += to_cents(operation[2]) if operation[1] == "d" else -to_cents(operation[2])
+
+    @property
+    def closing(self) -> int:
+        return self.opening + self.deposits - self.withdrawals
+
+    def operations(self) -> Iterator[tuple[str, str, int, int, int]]:
+        """Yields `(time, description, withdrawal, deposit, balance)`.
+        Totals are complete once it is exhausted.
+        """
+        balance: int = self.opening
+        operation: Operation | None = self._first
+        while operation is not None and operation[0] < self.till:
+            time, kind, amount, description, _ = operation
+            cents: int = to_cents(amount)
+            if kind == "d":
+                self.deposits += cents
+                balance += cents
+                yield time, description, 0, cents, balance
+            else:
+                self.withdrawals += cents
+                balance -= cents
+                yield time, description, cents, 0, balance
+            operation = next(self._history, None)
+
+
+def _write_txt(statement: Statement, file: TextIO) -> None:
+    file.write(f"Statement of account {statement.account_id} (client {statement.owner_id})\n")
+    file.write(f"From {statement.since} till {statement.till}\n\n")
+    file.write(f"{'Date':<19}  {'Description':<30}  {'Withdrawals':>12}  {'Deposits':>12}  {'Balance':>12}\n")
+    file.write(f"{'':<19}  {'Previous balance':<30}  {'':>12}  {'':>12}  {dollars(statement.opening):>12}\n")
+    for time, description, withdrawal, deposit, balance in statement.operations():
+        file.write(
+            f"{time:<19}  {description[:30]:<30}  {dollars(withdrawal) if withdrawal else '':>12}  "
+            f"{dollars(deposit) if deposit else '':>12}  {dollars(balance):>12}\n"
+        )
+    file.write(
+        f"{'':<19}  {'Totals':<30}  {dollars(statement.withdrawals):>12}  "
+        f"{dollars(statement.deposits):>12}  {dollars(statement.closing):>12}\n"
+    )
+
+
+def _write_csv(statement: Statement, file: TextIO) -> None:
+    writer = csv.writer(file)
+    writer.writerow(("date", "description", "withdrawal", "deposit", "balance"))
+    writer.writerow(("", "Previous balance", "", "", dollars(statement.opening)))
+    for time, description, withdrawal, deposit, balance in statement.operations():
+        writer.writerow((
+            time, description,
+            dollars(withdrawal) if withdrawal else "", dollars(deposit) if deposit else "", dollars(balance),
+        ))
+    writer.writerow(("", "Totals", dollars(statement.withdrawals), dollars(statement.deposits),
+                        dollars(statement.closing)))
+
+
+def _write_json(statement: Statement, file: TextIO) -> None:
+    # Written piece by piece, operations are never held in memory at once.
+    header: dict = {
+        "account_id": statement.account_id,
+        "owner_id": statement.owner_id,
+        "since": statement.since,
+        "till": statement.till,
+        "opening_balance": dollars(statement.opening),
+    }
+    file.write(json.dumps(header)[:-1] + ', "operations": [')
+    for number, (time, description, withdrawal, deposit, balance) in enumerate(statement.operations()):
+        operation: dict = {
+            "date": time,
+            "description": description,
+            "withdrawal": dollars(withdrawal),
+            "deposit": dollars(deposit),
+            "balance": dollars(balance),
+        }
+        file.write(("," if number else "") + json.dumps(operation))
+    footer: dict = {
+        "total_withdrawals": dollars(statement.withdrawals),
+        "total_deposits": dollars(statement.deposits),
+        "closing_balance": dollars(statement.closing),
+    }
+    file.write("], " + json.dumps(footer)[1:] + "\n")
+
+
+WRITERS = {"txt": _write_txt, "csv": _write_csv, "json": _write_json}
+
+
+def write_statement(account: Account, since: str, till: str, out_dir: str, file_format: str) -> None:
+    path: str = os.path.join(out_dir, file_name(account.id, file_format))
+    temporary: str = path + ".tmp"
+    with open(temporary, "w", newline="", encoding="utf-8") as file:
+        WRITERS[file_format](Statement(account, since, till), file)
+    os.replace(temporary, path)
+
+
+def _write_shard(shard: tuple[list[str], str, str, str, str]) -> int:
+    """Worker: writes statements of a shard of account IDs.
+    Returns the number of written statements.
+    """
+    account_ids, since, till, out_dir, file_format = shard
+    written: int = 0
+    for account_id in account_ids:
+        account: Account | None = Account.accounts.get(account_id)
+        if account is not None:
+            write_statement(account, since, till, out_dir, file_format)
+            written += 1
+    return written
+
+
+def generate(out_dir: str, since: str, till: str, file_format: str = "txt",
+                workers: int | None = None, progress: bool = True) -> tuple[int, int]:
+    """Writes statements of all accounts for `[since, till)`, both in
+    the history time format. Returns the numbers of written and
+    skipped (already written) statements.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"unknown statement format '{file_format}'")
+    os.makedirs(out_dir, exist_ok=True)
+    done: set[str] = set(os.listdir(out_dir))
+    account_ids: list[str] = [
+        account_id for account_id in list(Account.accounts)
+        if file_name(account_id, file_format) not in done
+    ]
+    skipped: int = len(Account.accounts) - len(account_ids)
+    shards: list[tuple] = [
+        (account_ids[start:start + SHARD_SIZE], since, till, out_dir, file_format)
+        for start in range(0, len(account_ids), SHARD_SIZE)
+    ]
+
+    workers = workers or os.cpu_count() or 1
+    if "fork" not in multiprocessing.get_all_start_methods():
+        workers = 1
+    written: int = 0
+    with Progress(disable=not progress) as bar:
+        task = bar.add_task("Statements", total=len(account_ids))
+        if workers == 1 or len(shards) <= 1:
+            results: Iterator[int] = map(_write_shard, shards)
+            for count in results:
+                written += count
+                bar.advance(task, count)
+        else:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                for count in pool.imap_unordered(_write_shard, shards):
+                    written += count
+                    bar.advance(task, count)
+    return written, skipped
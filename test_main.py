@@ -1,11 +1,33 @@
+import asyncio
+import collections
 import datetime
+import itertools
+import json
+import socket
+import sys
+import threading
 import time
+from decimal import Decimal
 import pytest
 from commands import (
     create_user, create_account,
     delete_user, delete_account,
     deposit, withdraw,
+    import_book,
 )
+import accrual
+import bulk
+import cdc
+import columnar
+import integrity
+import ledger
+import main
+import orders
+import replay
+import statements
+from profiler import Profiler
+from scheduler import Scheduler
+from loadgen import Workload, batch_target, run_closed
 from exceptions import (
     ClientNotFoundError,
     NegativeAmountError,
@@ -13,8 +35,13 @@ from exceptions import (
     AccountCreationError,
     ClientDoesNotExistError,
     AccountDoesNotExistError,
+    BulkImportError,
+    UnsupportedFormatError,
+    SchedulerOverloadedError,
+    FeedOffsetError,
+    FeedOverflowError,
 )
-from user import Account, User, AccountCreationError
+from user import Account, User, AccountCreationError, clear_book, memory_usage
 
 
 class TestsCreation:
@@ -458,3 +485,1081 @@ class TestsUtility:
 
         User.users.clear()
         Account.accounts.clear()
+
+class TestsMemory:
+    def test_records_have_no_dict(self) -> None:
+        """Tests if users and accounts are stored without
+        per-instance `__dict__`.
+        """
+        u: User = User("123")
+        a: Account = Account("asd", 10, owner_id="123")
+        assert not hasattr(u, "__dict__")
+        assert not hasattr(a, "__dict__")
+        assert not hasattr(a.balance, "__dict__")
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_memory_usage(self) -> None:
+        """Tests if memory report counts all the records."""
+        User("123")
+        User("456")
+        Account("asd", 10, owner_id="123")
+        deposit("123", 10)
+        deposit("123", 20)
+        usage = memory_usage()
+        assert usage["users"][0] == 2
+        assert usage["accounts"][0] == 1
+        assert usage["history"][0] == 2
+        assert all(size > 0 for _, size in usage.values())
+
+        # Times, amounts, descriptions and balances are counted too,
+        # the time shared by a batch once.
+        time = "2022-10-10 10:00:00"
+        Account.accounts["asd"]._post_many([(time, "d", 1.0, "x" * 1000), (time, "d", 2.0, "y" * 1000)])
+        grown = memory_usage()["history"][1] - usage["history"][1]
+        assert grown >= 2 * (sys.getsizeof("x" * 1000) + sys.getsizeof(1.0)) + sys.getsizeof(time)
+        assert grown < 2 * (sys.getsizeof("x" * 1000) + sys.getsizeof(1.0)) + 2 * sys.getsizeof(time) + 1000
+        User.users.clear()
+        Account.accounts.clear()
+
+class TestsBulk:
+    @pytest.mark.parametrize("file_name", ["book.csv", "book.jsonl"])
+    def test_export_import_roundtrip(self, tmp_path, file_name) -> None:
+        """Tests if exported book is imported back unchanged."""
+        User("123")
+        User("456")
+        User("789")
+        Account("asd", 10, owner_id="123")
+        Account("fgh", 0, owner_id="456")
+        deposit("123", 10.5, "salary, march")
+        withdraw("123", 0.01)
+        withdraw("456", 100, 'quoted "description"')
+        histories = {a.id: list(a.history) for a in Account.accounts.values()}
+        balances = {a.id: a.balance.value for a in Account.accounts.values()}
+
+        path = str(tmp_path / file_name)
+        assert bulk.dump(path) == 3 + 2 + 3
+        User.users.clear()
+        Account.accounts.clear()
+
+        assert bulk.load(path) == (3, 2, 3)
+        assert set(User.users) == {"123", "456", "789"}
+        assert {a.id: a.history for a in Account.accounts.values()} == histories
+        assert {a.id: a.balance.value for a in Account.accounts.values()} == balances
+        assert User.users["123"].account is Account.accounts["asd"]
+        assert not hasattr(User.users["789"], "account")
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_import_invalid_chunk(self) -> None:
+        """Tests if a chunk with an invalid record is not imported,
+        while previous chunks are kept.
+        """
+        records = [
+            {"type": "user", "id": "123"},
+            {"type": "account", "id": "asd", "owner_id": "123", "amount": "10"},
+            {"type": "user", "id": "456"},
+            {"type": "posting", "id": "asd", "time": "2022-10-10 10:00:00", "kind": "d", "amount": "0.001"},
+        ]
+        with pytest.raises(BulkImportError):
+            bulk.import_records(enumerate(records, start=1), chunk_size=2)
+        assert set(User.users) == {"123"}
+        assert set(Account.accounts) == {"asd"}
+        assert Account.accounts["asd"].history == []
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_import_duplicate_in_chunk(self) -> None:
+        """Tests if duplicates within one chunk are caught."""
+        records = [
+            {"type": "user", "id": "123"},
+            {"type": "account", "id": "asd", "owner_id": "123", "amount": "0"},
+            {"type": "account", "id": "fgh", "owner_id": "123", "amount": "0"},
+        ]
+        with pytest.raises(BulkImportError):
+            bulk.import_records(enumerate(records, start=1))
+        assert User.users == {}
+        assert Account.accounts == {}
+
+    @pytest.mark.parametrize("field, value", [
+        ("time", "2022-10-10 10:00+01"),
+        ("time", "2022-10-10T10:00:00"),
+        ("time", "2022-1a-10 10:00:00"),
+        ("amount", "inf"),
+        ("amount", "nan"),
+    ])
+    def test_invalid_posting(self, field, value) -> None:
+        posting = {"type": "posting", "id": "asd", "time": "2022-10-10 10:00:00", "kind": "d", "amount": "1"}
+        posting[field] = value
+        records = [
+            {"type": "user", "id": "123"},
+            {"type": "account", "id": "asd", "owner_id": "123", "amount": "0"},
+            posting,
+        ]
+        assert [line for line, _ in bulk._validate_chunk(list(enumerate(records, start=1)))] == [3]
+
+    @pytest.mark.parametrize("line, error", [
+        ('{"type": "user", "id": ', "line 2: invalid JSON"),
+        ('["user", "456"]', "line 2: record must be a JSON object"),
+    ])
+    def test_unreadable_line(self, tmp_path, capsys, line, error) -> None:
+        """Tests if a line that is not a JSON object is reported
+        and records before its chunk are kept.
+        """
+        path = tmp_path / "book.jsonl"
+        path.write_text('{"type": "user", "id": "123"}\n' + line + "\n")
+        with pytest.raises(BulkImportError):
+            bulk.load(str(path), chunk_size=1)
+        output = capsys.readouterr().out
+        assert error in output
+        assert "Imported 1 users" in output
+        assert set(User.users) == {"123"}
+
+        clear_book()
+
+    def test_chunk_size_positive(self, tmp_path) -> None:
+        path = str(tmp_path / "book.jsonl")
+        bulk.write_records(path, [{"type": "user", "id": "123"}])
+        with pytest.raises(ValueError):
+            bulk.load(path, chunk_size=0)
+        with pytest.raises(ValueError):
+            import_book(path, "0")
+        assert User.users == {}
+
+    def test_unsupported_format(self) -> None:
+        with pytest.raises(UnsupportedFormatError):
+            bulk.dump("book.xml")
+
+class TestsReplay:
+    def _write_book(self, path) -> None:
+        records = [
+            {"type": "user", "id": "123"},
+            {"type": "user", "id": "456"},
+            {"type": "account", "id": "asd", "owner_id": "123", "amount": "10"},
+            {"type": "account", "id": "fgh", "owner_id": "456", "amount": "0"},
+            {"type": "posting", "id": "asd", "time": "2022-10-09 10:00:00", "kind": "d", "amount": "5.5"},
+            {"type": "posting", "id": "fgh", "time": "2022-10-09 11:00:00", "kind": "w", "amount": "1"},
+            {"type": "posting", "id": "asd", "time": "2022-10-10 10:00:00", "kind": "w", "amount": "0.5"},
+            {"type": "posting", "id": "fgh", "time": "2022-10-11 10:00:00", "kind": "d", "amount": "100"},
+        ]
+        bulk.write_records(str(path), records)
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_replay(self, tmp_path, workers) -> None:
+        """Tests if replayed book matches the one built by import."""
+        path = tmp_path / "book.jsonl"
+        self._write_book(path)
+        bulk.load(str(path))
+        histories = {a.id: a.history for a in Account.accounts.values()}
+        User.users.clear()
+        Account.accounts.clear()
+        User("789")
+
+        assert replay.replay(str(path), workers) == (2, 2, 4)
+        assert set(User.users) == {"123", "456"}
+        assert {a.id: a.history for a in Account.accounts.values()} == histories
+        assert Account.accounts["asd"].balance.value == 15
+        assert Account.accounts["fgh"].balance.value == 99
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_replay_as_of(self, tmp_path) -> None:
+        """Tests if the state is reconstructed as of given date."""
+        path = tmp_path / "book.csv"
+        self._write_book(path)
+
+        replay.replay(str(path), 1, replay.normalize_as_of("2022-10-10"))
+        assert Account.accounts["asd"].balance.value == 15
+        assert Account.accounts["fgh"].balance.value == -1
+        assert len(Account.accounts["fgh"].history) == 1
+
+        replay.replay(str(path), 1, replay.normalize_as_of("2022-10-09T10:30:00"))
+        assert Account.accounts["asd"].balance.value == 15.5
+        assert Account.accounts["fgh"].history == []
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    @pytest.mark.parametrize("file_name", ["book.csv", "book.jsonl"])
+    def test_replay_shards(self, tmp_path, monkeypatch, file_name) -> None:
+        """Tests if a file read in many byte ranges, with descriptions
+        spanning lines, replays the same as it imports.
+        """
+        monkeypatch.setattr(replay, "SHARDS_PER_WORKER", 16)
+        records = [{"type": "user", "id": str(number)} for number in range(5)]
+        records += [{"type": "account", "id": f"a{number}", "owner_id": str(number), "amount": "1"} for number in range(5)]
+        records += [
+            {"type": "posting", "id": f"a{number % 5}", "time": f"2022-10-10 10:00:{number:02d}", "kind": "dw"[number % 2],
+                "amount": f"{number}.5", "description": f'line "{number}"\nnext, line' if number % 3 else ""}
+            for number in range(40)
+        ]
+        path = str(tmp_path / file_name)
+        bulk.write_records(path, records)
+        assert len(replay.boundaries(path, bulk.detect_format(path), 16)) > 8
+        bulk.load(path)
+        histories = {a.id: a.history for a in Account.accounts.values()}
+        clear_book()
+
+        assert replay.replay(path, 1) == (5, 5, 40)
+        assert {a.id: a.history for a in Account.accounts.values()} == histories
+        clear_book()
+        assert replay.replay(path, 2) == (5, 5, 40)
+        assert {a.id: a.history for a in Account.accounts.values()} == histories
+
+        clear_book()
+
+    def test_invalid_file_keeps_book(self, tmp_path, capsys) -> None:
+        """Tests if nothing is replaced when the file is invalid."""
+        User("789")
+        records = [
+            {"type": "user", "id": "x"},
+            {"type": "account", "id": "asd", "owner_id": "missing", "amount": "0"},
+            {"type": "posting", "id": "fgh", "time": "2022-10-10 10:00:00", "kind": "d", "amount": "1"},
+        ]
+        path = str(tmp_path / "book.jsonl")
+        bulk.write_records(path, records)
+        with open(path, "a", encoding="utf-8") as file:
+            file.write("not json\n")
+        with pytest.raises(BulkImportError):
+            replay.replay(path, 1)
+        assert "line 4: invalid JSON" in capsys.readouterr().out
+        assert set(User.users) == {"789"}
+        assert Account.accounts == {}
+
+        clear_book()
+
+class TestsProfiler:
+    def test_profiler_inactive(self) -> None:
+        """Tests if commands are executed as is when profiling is off."""
+        p = Profiler()
+        assert p.call("sum", sum, [1, 2]) == 3
+        assert p.timings == {}
+
+    def test_profiler_trace_and_alloc(self, tmp_path) -> None:
+        """Tests if deterministic and allocation profiles are collected
+        and dumped.
+        """
+        p = Profiler()
+        p.start("trace+alloc")
+        try:
+            p.call("create_user", create_user, "123")
+            p.call("create_account", create_account, "asd", "123")
+            for _ in range(3):
+                p.call("deposit", deposit, "123", 10)
+        finally:
+            p.stop()
+        assert p.timings["deposit"][0] == 3
+        assert p.stats is not None
+        assert "deposit" in p.allocations
+        written = p.dump(str(tmp_path / "profile"))
+        assert sorted(written) == sorted([
+            str(tmp_path / "profile.prof"),
+            str(tmp_path / "profile.alloc.txt"),
+        ])
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_profiler_sample(self, tmp_path) -> None:
+        """Tests if sampled stacks are written in collapsed format."""
+        p = Profiler()
+        p.interval = 0.001
+        p.start("sample")
+        try:
+            p.call("sleep", time.sleep, 0.1)
+        finally:
+            p.stop()
+        assert p.samples
+        path = tmp_path / "profile.folded"
+        assert p.dump(str(tmp_path / "profile")) == [str(path)]
+        stack, count = path.read_text().splitlines()[0].rsplit(" ", 1)
+        assert stack.startswith("sleep")
+        assert int(count) > 0
+
+    @pytest.mark.parametrize("mode", ["fast", "sample+trace", "sample+fast", ""])
+    def test_profiler_unknown_mode(self, mode) -> None:
+        with pytest.raises(ValueError):
+            Profiler().start(mode)
+
+    def test_profiler_mode_order(self) -> None:
+        """Tests if combined modes don't depend on their order."""
+        p = Profiler()
+        p.start("alloc+sample")
+        try:
+            assert (p.mode, p.track_allocations) == ("sample", True)
+        finally:
+            p.stop()
+
+class TestsSnapshot:
+    def test_snapshot_not_affected_by_postings(self) -> None:
+        """Tests if snapshot keeps balance and history as of
+        the moment it was taken.
+        """
+        User("123")
+        a: Account = Account("asd", 10, owner_id="123")
+        deposit("123", 5)
+        snapshot = a.snapshot()
+        withdraw("123", 100)
+        deposit("123", 1)
+
+        assert snapshot.balance.value == 15
+        assert len(snapshot) == 1
+        assert [operation[4] for operation in snapshot.history] == ["$15.0"]
+        assert a.balance.value == -84
+        assert len(a.history) == 3
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_balance_immutable(self) -> None:
+        """Tests if operations on balance don't change it."""
+        User("123")
+        a: Account = Account("asd", 10, owner_id="123")
+        balance = a.balance
+        assert (balance + 5).value == 15
+        assert (balance - 5).value == 5
+        assert balance.value == 10
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_concurrent_postings(self) -> None:
+        """Tests if concurrent postings are not lost and readers
+        always see matching balance and history.
+        """
+        User("123")
+        a: Account = Account("asd", 0, owner_id="123")
+        stop = threading.Event()
+        inconsistent = []
+
+        def read() -> None:
+            while not stop.is_set():
+                snapshot = a.snapshot()
+                if snapshot.length and list(snapshot.history)[-1][4] != str(snapshot.balance):
+                    inconsistent.append(snapshot)
+
+        def post() -> None:
+            for _ in range(200):
+                a._post("2022-10-10 10:00:00", "d", 1.0, "")
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        writers = [threading.Thread(target=post) for _ in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        stop.set()
+        reader.join()
+
+        assert inconsistent == []
+        assert a.balance.value == 800
+        assert len(a.history) == 800
+
+        User.users.clear()
+        Account.accounts.clear()
+
+class TestsScheduler:
+    def test_priority_order(self) -> None:
+        """Tests if queued postings run before lookups and reports."""
+        s = Scheduler()
+        executed = []
+        futures = [
+            s.submit("display_users", executed.append, "report"),
+            s.submit("create_user", executed.append, "lookup"),
+            s.submit("deposit", executed.append, "posting"),
+        ]
+        s.start(workers=1)
+        for future in futures:
+            future.result(timeout=5)
+        s.stop()
+        assert executed == ["posting", "lookup", "report"]
+        assert s.report()["postings"]["completed"] == 1
+
+    def test_load_shedding(self) -> None:
+        """Tests if commands are rejected when their queue is full,
+        without affecting other classes.
+        """
+        s = Scheduler()
+        s.queue_limits["reports"] = 2
+        s.submit("show_bank_statement", time.sleep, 0)
+        s.submit("show_bank_statement", time.sleep, 0)
+        with pytest.raises(SchedulerOverloadedError):
+            s.submit("show_bank_statement", time.sleep, 0)
+        s.submit("deposit", time.sleep, 0)
+        report = s.report()
+        assert report["reports"]["shed"] == 1
+        assert report["reports"]["queued"] == 2
+        assert report["postings"]["queued"] == 1
+        s.start(workers=2)
+        s.stop()
+        assert s.report()["reports"]["completed"] == 2
+
+    def test_reports_leave_workers_for_postings(self) -> None:
+        """Tests if slow reports cannot take every worker."""
+        s = Scheduler()
+        release = threading.Event()
+        s.start(workers=2)
+        reports = [s.submit("display_accounts", release.wait, 5) for _ in range(3)]
+        posting = s.submit("withdraw", sum, [1, 2])
+        assert posting.result(timeout=1) == 3
+        release.set()
+        for report in reports:
+            report.result(timeout=5)
+        s.stop()
+
+    def test_exceptions_propagate(self) -> None:
+        s = Scheduler()
+        s.start(workers=1)
+        with pytest.raises(ClientNotFoundError):
+            s.submit("deposit", deposit, "456", 10).result(timeout=5)
+        s.stop()
+
+class TestsLoadgen:
+    def test_workload_skew(self) -> None:
+        """Tests if hot accounts are picked more often than cold ones."""
+        workload = Workload(accounts=100, zipf=1.2, seed=1)
+        picks = collections.Counter(workload.client() for _ in range(5000))
+        assert picks["c1"] > picks["c10"] > picks.get("c100", 0)
+        assert set(picks) <= {f"c{rank}" for rank in range(1, 101)}
+
+    def test_workload_commands(self) -> None:
+        """Tests if generated commands follow the mix and include
+        quoted descriptions and invalid amounts.
+        """
+        workload = Workload(accounts=10, mix="deposit=1,withdraw=1", invalid=0.5, quoted=0.5, seed=2)
+        commands = [workload.command() for _ in range(200)]
+        assert {command.split()[0] for command in commands} == {"deposit", "withdraw"}
+        assert any(command.endswith('"') for command in commands)
+        assert any(float(command.split()[2]) <= 0 for command in commands)
+
+    def test_closed_loop_batch(self) -> None:
+        """Tests if generated traffic runs in-process and errors
+        of invalid amounts are counted.
+        """
+        workload = Workload(accounts=5, mix="deposit=1", invalid=0.5, seed=3)
+        connect = batch_target()
+        for user_input in workload.setup():
+            connect()(user_input)
+        results = run_closed(connect, itertools.islice(workload, 100), concurrency=2, duration=10)
+        assert len(results.latencies) == 100
+        assert set(results.errors) <= {"NegativeAmountError", "WrongAmountFormat"}
+        assert 0 < sum(results.errors.values()) < 100
+        assert sum(len(a.history) for a in Account.accounts.values()) == 100 - sum(results.errors.values())
+
+        User.users.clear()
+        Account.accounts.clear()
+
+class TestsAccrual:
+    SINCE = datetime.datetime(2022, 1, 1)
+    TILL = datetime.datetime(2023, 1, 1)
+    NOW = datetime.datetime(2023, 1, 1, 0, 0, 1)
+
+    def test_time_weighted_interest(self) -> None:
+        """Tests if interest is computed from the time-weighted balance
+        and posted once per account.
+        """
+        User("123")
+        a: Account = Account("asd", 1000, owner_id="123")
+        # Before the period: only changes the opening balance.
+        a._post("2021-12-31 12:00:00", "w", 500.0, "")
+        # Middle of the period: balance doubles for the second half.
+        a._post("2022-07-02 12:00:00", "d", 500.0, "")
+        # After the period: ignored.
+        a._post("2023-01-05 00:00:00", "d", 10000.0, "")
+
+        totals = accrual.accrue(self.SINCE, self.TILL, Decimal("0.1"), now=self.NOW)
+        # $500 for a half of the year, $1000 for the other half.
+        assert totals == {"accounts": 1, "interest": 7500, "overdraft": 0, "fees": 0, "skipped": 0}
+        assert a.history[-1] == ("2023-01-01 00:00:01", "d", 75.0, "Interest 2022-01-01..2023-01-01", "$11075.0")
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_overdraft_and_fee(self) -> None:
+        """Tests if negative balance is charged and fee is withdrawn
+        from every account in one batch.
+        """
+        User("123")
+        User("456")
+        a1: Account = Account("asd", -1000, owner_id="123")
+        a2: Account = Account("fgh", 0, owner_id="456")
+
+        totals = accrual.accrue(self.SINCE, self.TILL, Decimal("0.1"), Decimal("0.2"), Decimal("1.99"), now=self.NOW)
+        assert totals == {"accounts": 2, "interest": 0, "overdraft": 20000, "fees": 398, "skipped": 0}
+        assert [operation[1:4] for operation in a1.history] == [
+            ("w", 200.0, "Overdraft interest 2022-01-01..2023-01-01"),
+            ("w", 1.99, "Account fee 2022-01-01..2023-01-01"),
+        ]
+        assert a1.balance.value == -1201.99
+        assert a2.balance.value == -1.99
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_accrued_once(self) -> None:
+        """Tests if accounts already accrued for an overlapping period
+        are skipped, so a repeated run charges nothing twice.
+        """
+        User("123")
+        User("456")
+        a1: Account = Account("asd", 1000, owner_id="123")
+        accrual.accrue(self.SINCE, self.TILL, Decimal("0.1"), fee=Decimal("1"), accounts=[a1], now=self.NOW)
+        a2: Account = Account("fgh", 1000, owner_id="456")
+
+        totals = accrual.accrue(self.SINCE, self.TILL, Decimal("0.1"), fee=Decimal("1"), now=self.NOW)
+        assert totals == {"accounts": 1, "interest": 10000, "overdraft": 0, "fees": 100, "skipped": 1}
+        assert len(a1.history) == 2
+        overlapping = accrual.accrue(datetime.datetime(2022, 12, 1), datetime.datetime(2023, 2, 1),
+                                        Decimal("0.1"), fee=Decimal("1"), now=self.NOW)
+        assert overlapping["skipped"] == 2
+        following = accrual.accrue(self.TILL, datetime.datetime(2023, 2, 1), Decimal("0.1"), now=self.NOW)
+        assert following["skipped"] == 0
+
+        User.users.clear()
+        Account.accounts.clear()
+
+    def test_scalar_matches_numpy(self, monkeypatch) -> None:
+        """Tests if balance areas are the same with and without NumPy."""
+        pytest.importorskip("numpy")
+        for number in range(4):
+            User(str(number))
+            Account(str(number), 10 * number - 15, owner_id=str(number))
+        Account.accounts["1"]._post_many([
+            ("2021-06-01 00:00:00", "d", 20.0, ""),
+            ("2022-03-01 00:00:00", "w", 30.0, ""),
+            ("2022-03-01 00:00:00", "d", 0.01, ""),
+            ("2022-09-15 12:30:00", "d", 50.0, ""),
+            ("2023-02-01 00:00:00", "w", 500.0, ""),
+        ])
+        Account.accounts["3"]._post("2022-12-31 23:59:59", "w", 100.0, "")
+        columns = columnar.book_columns()
+        since, till = accrual.to_epoch(self.SINCE), accrual.to_epoch(self.TILL)
+
+        areas = accrual.balance_areas(columns, since, till)
+        monkeypatch.setitem(sys.modules, "numpy", None)
+        assert accrual.balance_areas(columns, since, till) == areas
+        march, september = (accrual.to_epoch(datetime.datetime(2022, 3, 1)),
+                            accrual.to_epoch(datetime.datetime(2022, 9, 15, 12, 30)))
+        # $15 till March, -$14.99 till September, $35.01 till the end.
+        assert (areas[0][1], areas[1][1]) == (1500 * (march - since) + 3501 * (till - september),
+                                                -1499 * (september - march))
+        assert (areas[0][0], areas[1][0]) == (0, -1500 * (till - since))
+
+        User.users.clear()
+        Account.accounts.clear()
+
+class TestsIntegrityChain:
+    def _book(self) -> None:
+        clear_book()
+        User("123")
+        User("456")
+        Account("asd", 10, owner_id="123")
+        Account("fgh", 0, owner_id="456")
+        deposit("123", 10)
+        withdraw("456", 5.5, "rent")
+
+    def test_digest_chained_on_append(self) -> None:
+        """Tests if the digest changes with every operation
+        and agrees with the history.
+        """
+        self._book()
+        a: Account = Account.accounts["asd"]
+        digest = a.digest
+        deposit("123", 1)
+        assert a.digest != digest
+        assert integrity.check_account(a) == []
+
+        clear_book()
+
+    def test_tampered_history(self) -> None:
+        """Tests if a changed past operation is detected."""
+        self._book()
+        a: Account = Account.accounts["asd"]
+        time_, kind, amount, description, balance = a.history[0]
+        a.history[0] = (time_, kind, 1000.0, description, balance)
+        assert integrity.check_account(a)
+
+        clear_book()
+
+    def test_root_incremental(self) -> None:
+        """Tests if incrementally maintained root equals the rebuilt one."""
+        self._book()
+        User("789")
+        Account("jkl", 1, owner_id="789")
+        deposit("789", 2)
+        delete_account("jkl")
+        root = integrity.tree.root()
+        integrity.rebuild()
+        assert integrity.tree.root() == root
+
+        deposit("123", 1)
+        assert integrity.tree.root() != root
+
+        clear_book()
+
+    def test_deleted_account_not_posted(self) -> None:
+        """Tests if postings after the account was deleted neither reach
+        the orphan nor shift the root.
+        """
+        self._book()
+        a: Account = Account.accounts["asd"]
+        delete_account("asd")
+        with pytest.raises(AccountDoesNotExistError):
+            deposit("123", 5)
+        a._post("2022-10-10 10:00:00", "d", 5.0, "")
+        assert len(a.history) == 1
+        root = integrity.tree.root()
+        integrity.rebuild()
+        assert integrity.tree.root() == root
+        # The owner may open another account.
+        Account("asd2", 0, owner_id="123")
+
+        clear_book()
+
+    def test_verify_against_backup(self, tmp_path) -> None:
+        """Tests if matching backup has the same root and divergent
+        accounts are found.
+        """
+        self._book()
+        path = str(tmp_path / "backup.jsonl")
+        bulk.dump(path)
+        other, digests = integrity.book_digests(bulk.read_records(path))
+        assert other.root() == integrity.tree.root()
+        assert integrity.diverging_accounts(other, digests) == []
+
+        deposit("123", 1)
+        User("789")
+        Account("jkl", 0, owner_id="789")
+        assert "jkl" in integrity.tree.members[integrity.bucket_of("jkl")]
+        # Only the members of divergent buckets are looked up.
+        accounts = Account.accounts
+        Account.accounts = type("NoScan", (dict,), {"values": None, "__iter__": None})(accounts)
+        try:
+            differences = integrity.diverging_accounts(other, digests)
+        finally:
+            Account.accounts = accounts
+        assert [account_id for account_id, _, _ in differences] == ["asd", "jkl"]
+        assert differences[1][2] is None
+
+        clear_book()
+
+    def test_invalid_backup(self, tmp_path, capsys) -> None:
+        """Tests if an invalid backup is reported instead of failing
+        on the first unknown account.
+        """
+        path = tmp_path / "backup.jsonl"
+        path.write_text(
+            '{"type": "user", "id": "123"}\n'
+            '{"id": "asd", "owner_id": "123"}\n'
+            '{"type": "posting", "id": "asd", "time": "2022-10-10 10:00:00", "kind": "d", "amount": "1"}\n'
+        )
+        with pytest.raises(BulkImportError):
+            integrity.book_digests(bulk.read_records(str(path)))
+        output = capsys.readouterr().out
+        assert "line 2: unknown record type 'None'" in output
+        assert "line 3: account 'asd' does not exist" in output
+
+    def test_verify_commands(self, tmp_path, capsys) -> None:
+        """Tests if the root is shown by a bare command and a backup
+        is compared by `verify <path>`.
+        """
+        self._book()
+        main.execute("verify_root")
+        assert integrity.tree.root().hex() in capsys.readouterr().out
+        path = str(tmp_path / "backup.jsonl")
+        bulk.dump(path)
+        main.execute(f"verify {path}")
+        assert "Book matches" in capsys.readouterr().out
+
+        clear_book()
+
+    def test_replay_keeps_root(self, tmp_path) -> None:
+        """Tests if the book replayed from a backup has the same root."""
+        self._book()
+        root = integrity.tree.root()
+        path = str(tmp_path / "backup.csv")
+        bulk.dump(path)
+        replay.replay(path, 1)
+        assert integrity.tree.root() == root
+
+        clear_book()
+
+class TestsChangeFeed:
+    def test_mutations_published(self) -> None:
+        """Tests if every change of the book is published in order."""
+        clear_book()
+        subscription = cdc.feed.subscribe()
+        create_user("123")
+        create_account("asd", "123", 10)
+        deposit("123", 5, "salary")
+        withdraw("123", 1)
+        delete_user("123")
+
+        events = subscription.poll()
+        assert [event["event"] for event in events] == [
+            "user_created", "account_created", "posted", "posted", "account_deleted", "user_deleted",
+        ]
+        assert [event["offset"] for event in events] == list(range(events[0]["offset"], events[0]["offset"] + 6))
+        assert events[2]["account_id"] == "asd"
+        assert events[2]["amount"] == 5
+        assert events[2]["description"] == "salary"
+        assert events[3]["balance"] == "$14.0"
+        assert subscription.poll() == []
+
+    def test_resume_and_batches(self) -> None:
+        """Tests if a subscriber resumes from an offset in batches."""
+        feed = cdc.ChangeFeed(capacity=100)
+        for number in range(10):
+            feed.publish("user_created", (str(number),))
+        subscription = feed.subscribe(offset=3)
+        subscription.max_events = 4
+        assert [event["user_id"] for event in subscription.poll()] == ["3", "4", "5", "6"]
+        resumed = feed.subscribe(offset=subscription.offset)
+        assert [event["offset"] for event in resumed.poll()] == [7, 8, 9]
+
+    def test_overflow(self) -> None:
+        """Tests if lagging subscriber gets an overflow error and
+        publishing doesn't wait for it.
+        """
+        feed = cdc.ChangeFeed(capacity=5)
+        subscription = feed.subscribe()
+        for number in range(8):
+            feed.publish("user_created", (str(number),))
+        with pytest.raises(FeedOverflowError):
+            subscription.poll()
+        assert feed.oldest_offset == 3
+        assert feed.subscribe(feed.oldest_offset).poll()[0]["user_id"] == "3"
+
+    def test_async_iterator(self) -> None:
+        feed = cdc.ChangeFeed()
+        subscription = feed.subscribe()
+        feed.publish("user_created", ("123",))
+
+        async def first_batch() -> list:
+            async for batch in subscription:
+                return batch
+
+        assert [event["user_id"] for event in asyncio.run(first_batch())] == ["123"]
+
+    def test_async_cancelled_wait(self) -> None:
+        """Tests if an event read for a cancelled wait is not skipped."""
+        feed = cdc.ChangeFeed()
+        subscription = feed.subscribe()
+
+        async def after_cancelled_wait() -> list:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(anext(aiter(subscription)), 0.05)
+            feed.publish("user_created", ("123",))
+            # The abandoned read returns the event meanwhile.
+            await asyncio.sleep(0.2)
+            return await asyncio.wait_for(anext(aiter(subscription)), 5)
+
+        assert [event["offset"] for event in asyncio.run(after_cancelled_wait())] == [0]
+
+    def test_batch_cap(self, monkeypatch) -> None:
+        """Tests if batches are capped whatever a subscriber asks for."""
+        monkeypatch.setattr(cdc, "MAX_BATCH", 3)
+        feed = cdc.ChangeFeed(capacity=4)
+        for number in range(6):
+            feed.publish("user_created", (str(number),))
+        # Wraps around the end of the buffer.
+        assert [event["user_id"] for event in feed.read(3, 10 ** 9)] == ["3", "4", "5"]
+
+    def test_socket(self) -> None:
+        """Tests if events are delivered over a socket from an offset."""
+        feed = cdc.ChangeFeed()
+        for number in range(3):
+            feed.publish("user_created", (str(number),))
+        server = cdc.serve_in_background(("127.0.0.1", 0), feed)
+        try:
+            with socket.create_connection(server.server_address, timeout=5) as connection:
+                file = connection.makefile("rwb")
+                file.write(b"1\n")
+                file.flush()
+                events = [json.loads(file.readline()) for _ in range(2)]
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert [event["user_id"] for event in events] == ["1", "2"]
+
+    def test_commands(self, capsys, monkeypatch) -> None:
+        """Tests if the bare command shows the feed and the server
+        is started by its own command.
+        """
+        main.execute("change_feed")
+        assert f"next offset {cdc.feed.next_offset}" in capsys.readouterr().out
+        addresses = []
+        monkeypatch.setattr(cdc, "serve_in_background", addresses.append)
+        main.execute("serve_change_feed :8766")
+        assert addresses == [("127.0.0.1", 8766)]
+
+    def test_offset_ahead(self) -> None:
+        """Tests if an offset the feed hasn't reached (e.g. saved
+        before a restart) is rejected instead of wrapping around.
+        """
+        feed = cdc.ChangeFeed(capacity=100)
+        for number in range(50):
+            feed.publish("user_created", (str(number),))
+        subscription = feed.subscribe(105)
+        with pytest.raises(FeedOffsetError):
+            subscription.poll()
+        assert subscription.offset == 105
+        assert feed.read(50) == []
+
+    @pytest.mark.parametrize("request_line, message", [
+        (b"abc\n", "expected `<offset>|latest [<batch size>]`, got 'abc'"),
+        (b"7\n", "offset 7 is ahead of the feed, next is 3"),
+    ])
+    def test_socket_error(self, request_line, message) -> None:
+        """Tests if an invalid request is answered with an error event."""
+        feed = cdc.ChangeFeed()
+        for number in range(3):
+            feed.publish("user_created", (str(number),))
+        server = cdc.serve_in_background(("127.0.0.1", 0), feed)
+        try:
+            with socket.create_connection(server.server_address, timeout=5) as connection:
+                file = connection.makefile("rwb")
+                file.write(request_line)
+                file.flush()
+                assert json.loads(file.readline()) == {"event": "error", "message": message}
+                assert file.readline() == b""
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestsStatements:
+    SINCE = "2022-10-01 00:00:00"
+    TILL = "2022-11-01 00:00:00"
+
+    def test_csv(self, tmp_path) -> None:
+        """Tests if opening balance includes postings before the period
+        and postings after it are left out.
+        """
+        User("123")
+        a: Account = Account("asd", 100, owner_id="123")
+        a._post("2022-09-30 12:00:00", "w", 30.0, "Before")
+        a._post("2022-10-05 12:00:00", "d", 10.5, "Salary, October")
+        a._post("2022-10-06 12:00:00", "w", 100.0, "Rent")
+        a._post("2022-11-01 00:00:00", "d", 1000.0, "After")
+
+        assert statements.generate(str(tmp_path), self.SINCE, self.TILL, "csv", progress=False) == (1, 0)
+        assert (tmp_path / "asd.csv").read_text().splitlines() == [
+            "date,description,withdrawal,deposit,balance",
+            ",Previous balance,,,70.00",
+            '2022-10-05 12:00:00,"Salary, October",,10.50,80.50',
+            "2022-10-06 12:00:00,Rent,100.00,,-19.50",
+            ",Totals,100.00,10.50,-19.50",
+        ]
+
+        clear_book()
+
+    def test_parallel_and_resume(self, tmp_path, monkeypatch) -> None:
+        """Tests if shards are written by worker processes and already
+        written statements are skipped.
+        """
+        monkeypatch.setattr(statements, "SHARD_SIZE", 2)
+        for number in range(5):
+            User(str(number))
+            Account(f"a{number}", number, owner_id=str(number))._post("2022-10-10 10:00:00", "d", 1.0, "")
+        (tmp_path / "a0.json").write_text("written before")
+
+        assert statements.generate(str(tmp_path), self.SINCE, self.TILL, "json", workers=2, progress=False) == (4, 1)
+        assert (tmp_path / "a0.json").read_text() == "written before"
+        statement: dict = json.loads((tmp_path / "a3.json").read_text())
+        assert statement["opening_balance"] == "3.00"
+        assert statement["closing_balance"] == "4.00"
+        assert [operation["deposit"] for operation in statement["operations"]] == ["1.00"]
+        assert sorted(path.name for path in tmp_path.iterdir()) == [f"a{number}.json" for number in range(5)]
+
+        clear_book()
+
+    def test_file_names(self, tmp_path) -> None:
+        """Tests if IDs that differ only by separators or dots get
+        files of their own, also when the job is resumed.
+        """
+        for account_id in ("a/b", "a_b", "..", "%2E%2E"):
+            User(account_id)
+            Account(account_id, 1, owner_id=account_id)
+
+        assert statements.generate(str(tmp_path), self.SINCE, self.TILL, "txt", progress=False) == (4, 0)
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            "%252E%252E.txt", "%2E%2E.txt", "a%2Fb.txt", "a_b.txt",
+        ]
+        assert "account a/b " in (tmp_path / "a%2Fb.txt").read_text()
+        assert statements.generate(str(tmp_path), self.SINCE, self.TILL, "txt", progress=False) == (0, 4)
+
+        clear_book()
+
+class TestsColumnar:
+    def setup_book(self) -> tuple[Account, Account]:
+        User("123")
+        User("456")
+        a1: Account = Account("asd", 10, owner_id="123")
+        a2: Account = Account("fgh", 0, owner_id="456")
+        a1._post_many([("2022-10-05 12:00:00", "d", 0.1, ""), ("2022-10-06 00:00:01", "w", 20.0, "")])
+        a2._post("1970-01-01 00:01:00", "d", 1.5, "")
+        return a1, a2
+
+    def test_columns(self) -> None:
+        a1, a2 = self.setup_book()
+        columns = columnar.book_columns()
+        assert columns.account_ids == ["asd", "fgh"]
+        assert list(columns.initial) == [1000, 0]
+        assert list(columns.account) == [0, 0, 1]
+        assert list(columns.time) == [1664971200, 1665014401, 60]
+        assert bytes(columns.kind) == b"dwd"
+        assert list(columns.amount) == [10, 2000, 150]
+        assert list(columns.balance) == [1010, -990, 150]
+        assert list(columnar.account_columns(a2).amount) == [150]
+        since = columnar.book_columns(since="2022-10-05 12:00:00")
+        assert (list(since.initial), list(since.account), list(since.balance)) == ([1010, 150], [0], [-990])
+
+        clear_book()
+
+    def test_numpy_shares_memory(self) -> None:
+        numpy = pytest.importorskip("numpy")
+        self.setup_book()
+        columns = columnar.book_columns()
+        arrays = columns.to_numpy()
+        assert str(arrays["time"][0]) == "2022-10-05T12:00:00"
+        assert arrays["kind"].tolist() == [b"d", b"w", b"d"]
+        columns.amount[0] = 42
+        assert arrays["amount"][0] == 42
+        assert numpy.shares_memory(arrays["balance"], numpy.frombuffer(columns.balance, dtype=numpy.int64))
+
+        clear_book()
+
+    def test_arrow(self) -> None:
+        pytest.importorskip("pyarrow")
+        self.setup_book()
+        table = columnar.book_columns().to_arrow()
+        assert table.column("account").to_pylist() == ["asd", "asd", "fgh"]
+        assert table.column("amount").to_pylist() == [10, 2000, 150]
+        assert table.column("kind").to_pylist() == [b"d", b"w", b"d"]
+
+        clear_book()
+
+class TestsLedger:
+    def test_totals(self) -> None:
+        """Tests if creation, postings and deletions keep bank-wide
+        and per-day totals up to date.
+        """
+        clear_book()
+        create_user("123")
+        create_user("456")
+        create_account("asd", "123", "100")
+        create_account("fgh", "456", "-5.5")
+        Account.accounts["asd"]._post_many([
+            ("2022-10-10 10:00:00", "d", 20.25, ""), ("2022-10-11 10:00:00", "w", 150.0, ""),
+        ])
+        assert ledger.ledger.summary() == {
+            "deposits": 2025, "withdrawals": 15000, "outstanding": -3525, "overdrawn": 2, "accounts": 2,
+        }
+        assert ledger.ledger.summary("2022-10-10")["deposits"] == 2025
+        # Backdated days were never closed by the ledger.
+        assert ledger.ledger.summary("2022-10-10")["outstanding"] is None
+        assert ledger.ledger.summary("2022-10-11")["withdrawals"] == 15000
+        assert ledger.ledger.summary(datetime.date.today().isoformat())["outstanding"] == -3525
+
+        delete_user("456")
+        deposit("123", 100)
+        assert ledger.ledger.summary() == {
+            "deposits": 12025, "withdrawals": 15000, "outstanding": 7025, "overdrawn": 0, "accounts": 1,
+        }
+        # Nothing changed today since the ledger was reset: still the current values.
+        del ledger.ledger.days[datetime.date.today().isoformat()]
+        today = ledger.ledger.summary(datetime.date.today().isoformat())
+        assert (today["deposits"], today["outstanding"], today["overdrawn"]) == (0, 7025, 0)
+        delete_account("asd")
+        assert ledger.ledger.summary()["outstanding"] == 0
+
+        clear_book()
+        assert ledger.ledger.summary()["deposits"] == 0
+
+    def test_deleted_account_not_booked(self) -> None:
+        """Tests if postings to a deleted account don't reach the ledger."""
+        clear_book()
+        create_user("u1")
+        create_account("a1", "u1", "10")
+        create_user("u2")
+        create_account("a2", "u2", "0")
+        a1: Account = Account.accounts["a1"]
+        delete_account("a1")
+        with pytest.raises(AccountDoesNotExistError):
+            deposit("u1", 5)
+        a1._post("2022-10-10 10:00:00", "d", 5.0, "")
+        assert ledger.ledger.summary() == {
+            "deposits": 0, "withdrawals": 0, "outstanding": 0, "overdrawn": 0, "accounts": 1,
+        }
+
+        clear_book()
+
+    def test_replay_and_rebuild(self, tmp_path) -> None:
+        """Tests if replaced histories are accounted for and rebuilding
+        from accounts gives the same totals.
+        """
+        User("123")
+        a: Account = Account("asd", 10, owner_id="123")
+        a._post("2022-10-10 10:00:00", "w", 20.0, "")
+        path: str = str(tmp_path / "book.jsonl")
+        bulk.dump(path)
+        a._post("2022-10-12 10:00:00", "d", 1.0, "")
+        replay.replay(path, 1, None)
+        expected: dict = {"deposits": 0, "withdrawals": 2000, "outstanding": -1000, "overdrawn": 1, "accounts": 1}
+        assert ledger.ledger.summary() == expected
+        ledger.rebuild()
+        assert ledger.ledger.summary() == expected
+
+        clear_book()
+
+class TestsOrders:
+    def test_due_orders_run_in_batches(self) -> None:
+        """Tests if due orders are posted once per account, recurring
+        ones are rescheduled and the rest wait.
+        """
+        book = orders.OrderBook()
+        User("123")
+        User("456")
+        a1: Account = Account("asd", 0, owner_id="123")
+        a2: Account = Account("fgh", 0, owner_id="456")
+        book.add("123", "d", 1000.0, datetime.datetime(2022, 10, 1), "monthly", "Salary")
+        book.add("123", "w", 300.0, datetime.datetime(2022, 10, 1), "once", "Rent")
+        book.add("456", "d", 5.0, datetime.datetime(2022, 10, 2))
+
+        assert book.run(datetime.datetime(2022, 10, 1, 12)) == (2, 1)
+        assert [operation[1:4] for operation in a1.history] == [("d", 1000.0, "Salary"), ("w", 300.0, "Rent")]
+        assert a1.history[0][0] == "2022-10-01 12:00:00"
+        assert a2.history == []
+        assert len(book) == 2
+
+        # Two monthly periods passed.
+        assert book.run(datetime.datetime(2022, 12, 5)) == (3, 2)
+        assert a1.balance.value == 2700.0
+        assert a2.balance.value == 5.0
+        assert [order.due for order in book.orders.values()] == [datetime.datetime(2023, 1, 1)]
+
+        clear_book()
+
+    def test_cancel_and_missing_accounts(self) -> None:
+        book = orders.OrderBook()
+        User("123")
+        a: Account = Account("asd", 0, owner_id="123")
+        order = book.add("123", "d", 1.0, datetime.datetime(2022, 10, 1), "daily")
+        book.add("404", "d", 1.0, datetime.datetime(2022, 10, 1), "daily")
+        assert book.cancel(order.id) is order
+        assert book.cancel(order.id) is None
+
+        assert book.run(datetime.datetime(2022, 10, 3)) == (0, 0)
+        assert a.history == []
+        assert len(book) == 0
+
+        clear_book()
+
+    def test_month_end(self) -> None:
+        assert orders.next_due(datetime.datetime(2022, 1, 31), "monthly", 31) == datetime.datetime(2022, 2, 28)
+        assert orders.next_due(datetime.datetime(2022, 2, 28), "monthly", 31) == datetime.datetime(2022, 3, 31)
+        assert orders.next_due(datetime.datetime(2022, 12, 15), "monthly", 15) == datetime.datetime(2023, 1, 15)
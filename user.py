@@ -1,5 +1,9 @@
+import hashlib
+import itertools
+import sys
+import threading
 from datetime import datetime
-from typing import Self, TypeAlias
+from typing import Callable, Iterator, Self, TypeAlias
 from rich import print as rprint
 from exceptions import (
     AccountCreationError,
@@ -12,20 +16,60 @@ from exceptions import (
 # part of the task for it.
 Operation: TypeAlias = tuple[datetime, str, float, str, "_Balance"]
 
+# Listeners are called as `listener(event, record, previous)` after every
+# change of the book (see `subscribe`):
+#   *"user_created", "user_deleted": `record` is the user, `previous` is None.
+#   *"account_created": `record` is the account, `previous` is None.
+#   *"account_deleted": `previous` is the last `Account._head`.
+#   *"posted", "history_replaced": `previous` is `Account._head` before
+#       the change, new operations are `record.history[previous[1]:]`.
+#   *"book_cleared": `record` and `previous` are None.
+# Postings notify under the account's write lock, so listeners must be quick.
+_listeners: list[Callable] = []
+
+def subscribe(listener: Callable) -> None:
+    _listeners.append(listener)
+
+def unsubscribe(listener: Callable) -> None:
+    _listeners.remove(listener)
+
+def _notify(event: str, record, previous) -> None:
+    for listener in _listeners:
+        listener(event, record, previous)
+
 class User:
+    # `__slots__` drop the per-instance `__dict__`, which is most of
+    # the memory of a record once there are millions of them.
+    # Unset `account` slot still makes `hasattr(user, "account")` False.
+    __slots__ = ("id", "account")
     users: dict[str, Self] = {}
 
     def __new__(cls, id: str) -> Self:
-        if id in cls.users:
-            print(f"User exists. Your variable points to {cls.users[id]}.")
-            return cls.users[id]
+        user: Self | None = cls.users.get(id)
+        if user is not None:
+            print(f"User exists. Your variable points to {user}.")
+            return user
         else:
             return super().__new__(cls)
 
     def __init__(self, id: str) -> None:
         super().__init__()
+        # Interned ids are shared between the registry keys,
+        # `Account.owner` links and history lookups.
+        id = sys.intern(str(id))
+        if self.users.get(id) is self:
+            # `__new__` returned the existing user.
+            return
         self.id: str = id
         self.users[id]: Self = self
+        _notify("user_created", self, None)
+
+    def _delete(self) -> None:
+        """Removes the user and their account from the book."""
+        if hasattr(self, "account") and Account.accounts.get(self.account.id) is self.account:
+            self.account._delete()
+        self.users.pop(self.id)
+        _notify("user_deleted", self, None)
 
     def _set_account(self, account: "Account") -> None:
         self.account: Account = account
@@ -34,12 +78,18 @@ class User:
         return f"User: id='{self.id}'"
 
 class Account:
+    # `_head` is `(balance, history length, history, digest)`. Writers
+    # publish a new one after appending to the history, so readers get
+    # a consistent view with a single attribute read (see `snapshot`).
+    # `digest` chains hashes of all the operations (see `_chain_digest`).
+    __slots__ = ("id", "_head", "owner", "_initial_balance")
     accounts: dict[str, Self] = {}
 
     def __new__(cls, id: str, balance: float = 0, *, owner_id: str) -> Self:
         acc_exists: bool = id in cls.accounts
-        client_has_acc: bool = hasattr(User.users.get(owner_id), "account")
-        client_exists: bool = User.users.get(owner_id) is not None
+        owner: User | None = User.users.get(owner_id)
+        client_exists: bool = owner is not None
+        client_has_acc: bool = client_exists and hasattr(owner, "account")
         if acc_exists:
             rprint("Account with this [red]id [white] already exists.")
             raise AccountCreationError
@@ -53,15 +103,76 @@ class Account:
 
     def __init__(self, id: str, balance: str = 0, *, owner_id: str) -> None:
         super().__init__()
+        id = sys.intern(str(id))
         self.id: str = id
-        self.balance: float = _Balance(balance)
+        self._head: tuple[_Balance, int, list[Operation], bytes] = (
+            _Balance(balance), 0, [], _genesis_digest(id, balance),
+        )
         self.accounts[id]: Self = self
-
-        self.history: list[Operation] = []
             
         self.owner: User = User.users[owner_id]
         self.owner._set_account(self)
         self._initial_balance: float = balance
+        _notify("account_created", self, None)
+
+    def _delete(self) -> None:
+        """Removes the account from the book, its owner is kept
+        and may open another one.
+        """
+        with _write_lock(self.id):
+            self.accounts.pop(self.id)
+            if getattr(self.owner, "account", None) is self:
+                del self.owner.account
+            _notify("account_deleted", self, self._head)
+
+    @property
+    def balance(self) -> "_Balance":
+        return self._head[0]
+
+    @property
+    def history(self) -> list[Operation]:
+        return self._head[2]
+
+    @property
+    def digest(self) -> bytes:
+        return self._head[3]
+
+    def snapshot(self) -> "AccountSnapshot":
+        """Consistent view of the account at this moment.
+        Nothing is copied and postings are not blocked.
+        """
+        return AccountSnapshot(self.id, *self._head)
+
+    def _post(self, time: str, kind: str, amount: float, description: str) -> None:
+        """Applies one already validated operation to the account."""
+        self._post_many(((time, kind, amount, description),))
+
+    def _post_many(self, operations) -> None:
+        """Applies already validated operations to the account.
+
+        `operations` is an iterable of `(time, kind, amount, description)`,
+        `kind` being "d" for deposits and "w" for withdrawals.
+        All the operations are appended to the history at once.
+        Deleted accounts are left as they are.
+        """
+        with _write_lock(self.id):
+            if self.accounts.get(self.id) is not self:
+                return
+            previous = self._head
+            balance, _, history, digest = previous
+            balance, new_history, digest = _apply_operations(balance, operations, digest)
+            history.extend(new_history)
+            self._head = (balance, len(history), history, digest)
+            _notify("posted", self, previous)
+
+    def _replace_history(self, history: list[Operation], balance: "_Balance", digest: bytes) -> None:
+        """Replaces the whole state of the account, e.g. after it was
+        rebuilt elsewhere by `_apply_operations`.
+        """
+        with _write_lock(self.id):
+            previous = self._head
+            self._head = (balance, len(history), history, digest)
+            _notify("history_replaced", self, previous)
 
     def __repr__(self) -> str:
         return f"Account: id='{self.id}', owner='{self.owner}'"
@@ -84,22 +195,26 @@ class _Balance:
         *$521.92 + $13.21 = $521.92 * ¢100 + $13.21 * 100¢ = ¢52192 + ¢1321 =
             = ¢53513 = $535.13
     """
+    __slots__ = ("value",)
+
     def __init__(self, initial_balance: str) -> None:
         self.value: float = float(initial_balance)
     
+    # Operations return new balances and never change `self`: balances
+    # are shared by account snapshots and history entries.
     def __add__(self, other) -> float:
         other = float(other)
-        self.value *= 100
+        value: float = self.value * 100
         other *= 100
-        result: int = self.value + other
+        result: int = value + other
         new_balance = _Balance(str(result / 100))
         return new_balance
     
     def __sub__(self, other) -> float:
         other = float(other)
-        self.value *= 100
+        value: float = self.value * 100
         other *= 100
-        result: int = self.value - other
+        result: int = value - other
         new_balance = _Balance(str(result / 100))
         return new_balance
     
@@ -108,3 +223,120 @@ class _Balance:
             return f"-${-self.value}"
         else:
             return f"${self.value}"
+
+
+class AccountSnapshot:
+    """Read-only view of an account at the moment it was taken.
+
+    Histories are append-only, so the first `length` operations of
+    the history list never change: the snapshot keeps a reference to
+    the list instead of copying it, while writers keep appending.
+    """
+    __slots__ = ("account_id", "balance", "length", "_history", "digest")
+
+    def __init__(self, account_id: str, balance: _Balance, length: int,
+                    history: list[Operation], digest: bytes) -> None:
+        self.account_id: str = account_id
+        self.balance: _Balance = balance
+        self.length: int = length
+        self._history: list[Operation] = history
+        self.digest: bytes = digest
+
+    @property
+    def history(self) -> Iterator[Operation]:
+        return itertools.islice(self._history, self.length)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __repr__(self) -> str:
+        return f"AccountSnapshot: id='{self.account_id}', balance='{self.balance}', operations={self.length}"
+
+
+# Postings to the same account are serialized, readers never take these.
+# Locks are striped by account ID, so accounts don't need one each.
+_WRITE_LOCKS: tuple[threading.Lock, ...] = tuple(threading.Lock() for _ in range(64))
+
+def _write_lock(account_id: str) -> threading.Lock:
+    return _WRITE_LOCKS[hash(account_id) % len(_WRITE_LOCKS)]
+
+
+def _genesis_digest(account_id: str, initial_balance) -> bytes:
+    """Digest of an account without operations."""
+    return hashlib.blake2b(f"{account_id}\x1f{float(initial_balance)}".encode(), digest_size=16).digest()
+
+
+def _chain_digest(digest: bytes, operation: Operation) -> bytes:
+    """Digest of the history after appending `operation` to a history
+    with `digest`. Changing any past operation changes all the
+    following digests.
+    """
+    time, kind, amount, description, balance = operation
+    return hashlib.blake2b(
+        digest + f"{time}\x1f{kind}\x1f{amount}\x1f{description}\x1f{balance}".encode(),
+        digest_size=16,
+    ).digest()
+
+
+def _apply_operations(balance: _Balance, operations,
+                        digest: bytes) -> tuple[_Balance, list[Operation], bytes]:
+    """Runs operations over a starting balance and history digest.
+
+    Returns the final balance, the history entries of the operations
+    and the final digest, without touching any account.
+    See `Account._post_many`.
+    """
+    history: list[Operation] = []
+    for time, kind, amount, description in operations:
+        if kind == "d":
+            balance += amount
+        else:
+            balance -= amount
+        operation: Operation = (time, kind, amount, description, str(balance))
+        digest = _chain_digest(digest, operation)
+        history.append(operation)
+    return balance, history, digest
+
+
+def clear_book() -> None:
+    """Removes all users and accounts."""
+    User.users.clear()
+    Account.accounts.clear()
+    _notify("book_cleared", None, None)
+
+
+def memory_usage() -> dict[str, tuple[int, int]]:
+    """Approximate memory taken by the registries.
+
+    Returns `{name: (number of records, bytes)}`. Only the objects
+    owned by the bank are counted: records, balances, history lists,
+    operation tuples and their times, amounts, descriptions and
+    balances. Objects shared by several operations (e.g. the time
+    of a batch) are counted once.
+    """
+    users_bytes: int = sys.getsizeof(User.users)
+    for user in User.users.values():
+        users_bytes += sys.getsizeof(user)
+
+    accounts_bytes: int = sys.getsizeof(Account.accounts)
+    history_bytes: int = 0
+    operations: int = 0
+    # IDs of the operations' elements counted so far.
+    seen: set[int] = set()
+    for account in Account.accounts.values():
+        accounts_bytes += (sys.getsizeof(account) + sys.getsizeof(account._head)
+                            + sys.getsizeof(account.balance) + sys.getsizeof(account.digest))
+        history_bytes += sys.getsizeof(account.history)
+        for operation in account.history:
+            history_bytes += sys.getsizeof(operation)
+            for element in operation:
+                if id(element) not in seen:
+                    seen.add(id(element))
+                    history_bytes += sys.getsizeof(element)
+        operations += len(account.history)
+
+    return {
+        "users": (len(User.users), users_bytes),
+        "accounts": (len(Account.accounts), accounts_bytes),
+        "history": (operations, history_bytes),
+    }